@@ -0,0 +1,692 @@
+# Offline replay and load test for tweetbot.py. Twitter, the Computer Vision API and Mongo are
+# replaced by local stand-ins, and synthetic (or recorded) conversations are played through
+# poll at a fixed rate, the same way the cron job or daemon would see them. Reports p50/p99
+# latency per stage and questions sent per second.
+#
+#   python replay.py --conversations 200 --rate 10
+#   python replay.py --recorded conversations.json --payloads vision.json --mongo localhost:27017
+#
+# recorded conversations are a JSON list of {"kind": "tweet" or "dm", "replies": [...]}, with an
+# optional "payload" holding the vision API response for its photo. --payloads is a JSON list
+# of recorded vision API responses, handed out to conversations in turn. With --mongo the run
+# uses a throwaway reflect_replay database on that server; otherwise it needs mongomock.
+#
+#   python replay.py --conversations 200 --rate 20 --workers 4 --mongo localhost:27017
+#
+# polls and sends from this process but leaves the jobs to that many worker processes, each
+# running the bot's own run_worker_process and splitting the shards between them, to see how
+# questions/s scales. The processes have to share a database, so this needs --mongo.
+#
+#   python replay.py --cold-start 10
+#
+# times what a cron run with nothing to do costs instead, and fails if it loads any of the
+# dependencies that are meant to wait until a message needs them.
+#
+#   python replay.py --lookups 1000000 --mongo localhost:27017
+#
+# times looking conversations up with and without the indexes ensure_indexes creates.
+#
+#   python replay.py --expansions 200
+#
+# counts the grammar expansions each question takes, with rejection sampling and pruned.
+#
+#   python replay.py --one-time-rules 2000
+#
+# times listing the one-time rules in expansions of the real question grammar.
+#
+#   python replay.py --sentiment 200
+#
+# times scoring replies with a new VADER analyzer per call against the shared one.
+#
+#   python replay.py --compaction 100000 --mongo localhost:27017
+#
+# fills the conversations collection with that many finished conversations and times looking
+# up active ones, before and after they are archived.
+
+import argparse
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import threading
+import subprocess
+import time
+
+import pymongo
+import tweepy
+
+import tweetbot
+
+PAYLOADS = [
+    {'tags': [{'name': 'dog', 'confidence': 0.95}, {'name': 'outdoor', 'confidence': 0.8}],
+        'faces': [], 'metadata': {'height': 1080, 'width': 1440}},
+    {'tags': [{'name': 'person', 'confidence': 0.97}, {'name': 'indoor', 'confidence': 0.7}],
+        'faces': [{'age': 27, 'faceRectangle': {'height': 400, 'width': 380}}], 'metadata': {'height': 1080, 'width': 1440}},
+    {'tags': [{'name': 'people', 'confidence': 0.9}, {'name': 'city', 'confidence': 0.75}],
+        'faces': [{'age': 34, 'faceRectangle': {'height': 120, 'width': 110}}, {'age': 8, 'faceRectangle': {'height': 90, 'width': 80}}],
+        'metadata': {'height': 1080, 'width': 1920}},
+    {'tags': [{'name': 'food', 'confidence': 0.88}, {'name': 'indoor', 'confidence': 0.9}],
+        'faces': [], 'metadata': {'height': 1200, 'width': 1200}},
+    {'tags': [{'name': 'mountain', 'confidence': 0.92}, {'name': 'outdoor', 'confidence': 0.99}],
+        'faces': [], 'metadata': {'height': 2000, 'width': 3000}},
+    {'tags': [{'name': 'text', 'confidence': 0.8}, {'name': 'document', 'confidence': 0.7}],
+        'faces': [], 'metadata': {'height': 800, 'width': 600}},
+    {'tags': [{'name': 'wall', 'confidence': 0.5}], 'faces': [], 'metadata': {'height': 640, 'width': 480}}]
+
+REPLIES = ['yes', 'yes it is me', 'no', 'not really', 'I took it last summer', 'it made me really happy',
+    'my sister', 'about three years', 'I love it there', 'it was a sad day']
+
+# stands in for tweepy.API. messages are built with tweepy's own models so that they look
+# exactly like what the real API hands back.
+class FakeTwitter(object):
+    def __init__(self, on_reply):
+        self.parser = tweepy.parsers.ModelParser()
+        self.ids = itertools.count(10**18)
+        self.lock = threading.Lock()
+        self.mentions = []
+        self.dms = []
+        self.on_reply = on_reply
+
+    def page(self, items, since_id, max_id, count):
+        with self.lock:
+            found = [m for m in items if m.id > since_id and (max_id is None or m.id <= max_id)]
+        return sorted(found, key=lambda m: -m.id)[:count]
+
+    def mentions_timeline(self, since_id=None, max_id=None, count=20, **kwargs):
+        return self.page(self.mentions, since_id, max_id, count)
+
+    def direct_messages(self, since_id=None, max_id=None, count=20, **kwargs):
+        return self.page(self.dms, since_id, max_id, count)
+
+    def mention(self, user, text, media=None, reply_to=None):
+        with self.lock:
+            status = tweepy.Status.parse(self, {
+                'id': next(self.ids),
+                'full_text': text,
+                'entities': {'media': [{'media_url': media}]} if media else {},
+                'in_reply_to_status_id': reply_to,
+                'user': {'id': abs(hash(user)), 'screen_name': user}})
+            self.mentions.append(status)
+        return status
+
+    def dm(self, sender_id, text, media=None):
+        with self.lock:
+            message = tweepy.DirectMessage.parse(self, {
+                'id': next(self.ids),
+                'text': text,
+                'sender_id': sender_id,
+                'entities': {'media': [{'media_url': media}]} if media else {}})
+            self.dms.append(message)
+        return message
+
+    def update_status(self, text, in_reply_to_status_id=None):
+        status = tweepy.Status.parse(self, {'id': next(self.ids), 'full_text': text})
+        self.on_reply('tweet', in_reply_to_status_id, status)
+        return status
+
+    def send_direct_message(self, user, text=None):
+        message = tweepy.DirectMessage.parse(self, {'id': next(self.ids), 'text': text})
+        self.on_reply('dm', user, message)
+        return message
+
+# stands in for VisionClient, answering with the payload recorded for each photo after an
+# optional delay
+class FakeVision(object):
+    def __init__(self, payloads, latency=0.0):
+        self.payloads = payloads
+        self.latency = latency
+
+    def analyze(self, body, content_type):
+        if self.latency > 0:
+            time.sleep(random.expovariate(1.0 / self.latency))
+        index = int(re.search(r'replay/(\d+)\.jpg', body).group(1))
+        return json.loads(json.dumps(self.payloads[index]))
+
+    def stats(self):
+        return {}
+
+# mongomock isn't thread safe, and its find_one_and_update isn't atomic the way mongod's is,
+# which lets two workers lease the same job. serialize every collection call instead (once,
+# however many replays a process sets up).
+def serialize_mongomock(collection_class):
+    if getattr(collection_class, 'serialized', False):
+        return
+    collection_class.serialized = True
+    lock = threading.RLock()
+    def locked(method):
+        def wrapper(*args, **kwargs):
+            with lock:
+                return method(*args, **kwargs)
+        return wrapper
+    for name in ['find', 'find_one', 'find_one_and_update', 'insert_one', 'update_one', 'update_many',
+            'delete_one', 'delete_many', 'count', 'create_index', 'drop_indexes']:
+        setattr(collection_class, name, locked(getattr(collection_class, name)))
+
+# QuestionGenerator always opens the reflect database, so point that at a scratch one
+class ScratchClient(object):
+    def __init__(self, client, drop=True):
+        if drop:
+            client.drop_database('reflect_replay')
+        self.reflect = client['reflect_replay']
+
+def connect(mongo):
+    if mongo is None:
+        import mongomock
+        serialize_mongomock(mongomock.collection.Collection)
+        return mongomock.MongoClient()
+    host, _, port = mongo.partition(':')
+    return pymongo.MongoClient(host, int(port or 27017))
+
+KEYS = {'microsoft': 'replay', 'twitter': {'consumer_token': 'replay', 'consumer_secret': 'replay', 'key': 'replay', 'secret': 'replay'}}
+
+# entry point for the --workers processes. the stand-ins are set up again in each one, on the
+# scratch database the replay already filled, before handing over to the bot's worker loop.
+# replies are queued in the outbox, which the replay process sends.
+def replay_worker(mongo, payloads, vision_latency, threads):
+    client = connect(mongo)
+    tweetbot.pymongo.MongoClient = lambda *args, **kwargs: ScratchClient(client, drop=False)
+    tweetbot.tweepy.API = lambda auth: FakeTwitter(None)
+    tweetbot.VisionClient = lambda *args, **kwargs: FakeVision(payloads, vision_latency)
+    tweetbot.QuestionGenerator.download_dm_media = lambda self, url: url
+    quietly(tweetbot.run_worker_process, KEYS, [], {'verbose': False, 'threads': threads})
+
+class Replay(object):
+    # with workers, jobs are left to that many replay_worker processes
+    def __init__(self, scripts, payloads, rate, think, vision_latency, mongo, threads, workers=0):
+        self.scripts = scripts
+        self.rate = rate
+        self.think = think
+        self.workers = workers
+        self.worker_args = (mongo, payloads, vision_latency, threads)
+        self.timings = {}
+        self.arrivals = {}
+        self.schedule = []
+        self.lock = threading.Lock()
+        self.owners = {}
+        self.finished = 0
+        self.sent = 0
+
+        client = connect(mongo)
+        self.twitter = FakeTwitter(self.on_reply)
+        tweetbot.pymongo.MongoClient = lambda *args, **kwargs: ScratchClient(client)
+        tweetbot.tweepy.API = lambda auth: self.twitter
+        self.generator = tweetbot.QuestionGenerator(KEYS, [], verbose=False, threads=threads)
+        if mongo is None:
+            # mongomock ignores partialFilterExpression, so the partial unique indexes would
+            # reject the second conversation without a last_tweet_id
+            self.generator.db.conversations.drop_indexes()
+        self.generator.db.status.insert_one({'type': 'current', 'last_tweet': 1, 'last_dm': 1})
+
+        self.generator.vision = FakeVision(payloads, vision_latency)
+        self.generator.download_dm_media = lambda url: url
+        self.generator.outbox.min_spacing = 0
+        # retry failed jobs quickly, so that a conversation that keeps failing gives up within
+        # the run instead of holding it open
+        self.generator.jobs.backoff = 0.1
+        self.generator.outbox.limits = {'update_status': (10**9, 1), 'send_direct_message': (10**9, 1)}
+
+        self.timed(self.generator, 'ingest', 'ingest')
+        self.timed(self.generator.vision, 'vision', 'analyze')
+        self.timed(self.generator, 'analyze', 'analyze_image')
+        self.timed(self.generator, 'sentiment', 'confirmed_many')
+        self.timed(self.generator, 'grammar', 'expand_constrained')
+        self.timed(self.generator, 'generate', 'get_question')
+        self.timed(self.generator, 'mongo', 'save_conversation')
+        self.timed(self.generator.outbox, 'send', 'send')
+
+    def timed(self, obj, stage, name):
+        method = getattr(obj, name)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.timings.setdefault(stage, []).append(time.time() - start)
+        setattr(obj, name, wrapper)
+
+    def post(self, script, text, reply_to=None, media=None):
+        if script['kind'] == 'dm':
+            message = self.twitter.dm(script['sender_id'], text, media=media)
+            script['last_message'] = message.id
+        else:
+            message = self.twitter.mention(script['user'], text, media=media, reply_to=reply_to)
+            self.owners[message.id] = script
+        self.arrivals[message.id] = time.time()
+
+    # a reply from the bot: time it, then have the user answer after a while
+    def on_reply(self, kind, target, response):
+        now = time.time()
+        with self.lock:
+            self.sent += 1
+            script = self.owners[target]
+            incoming = script['last_message'] if kind == 'dm' else target
+            self.timings.setdefault('end_to_end', []).append(now - self.arrivals[incoming])
+
+            if len(script['replies']) > 0:
+                reply = script['replies'].pop(0)
+                heapq.heappush(self.schedule, (now + random.expovariate(1.0 / self.think) if self.think > 0 else now,
+                    next(self.order), script, reply, response.id))
+            else:
+                self.finished += 1
+
+    def run(self, timeout):
+        self.order = itertools.count()
+        start = time.time()
+        for i, script in enumerate(self.scripts):
+            script['media'] = 'http://replay/' + str(i) + '.jpg'
+            if script['kind'] == 'dm':
+                script['sender_id'] = 1000 + i
+                self.owners[script['sender_id']] = script
+            else:
+                script['user'] = 'replay' + str(i)
+            heapq.heappush(self.schedule, (start + i / float(self.rate), next(self.order), script, None, None))
+
+        processes = [multiprocessing.Process(target=replay_worker, args=self.worker_args) for _ in range(self.workers)]
+        for process in processes:
+            process.start()
+        if self.workers == 0:
+            self.generator.start_question_pool()
+        while self.finished < len(self.scripts) and time.time() - start < timeout and not self.stalled():
+            now = time.time()
+            with self.lock:
+                while len(self.schedule) > 0 and self.schedule[0][0] <= now:
+                    _, _, script, text, reply_to = heapq.heappop(self.schedule)
+                    if text is None:
+                        self.post(script, '@SnapshotReflect', media=script['media'])
+                    else:
+                        self.post(script, text, reply_to=reply_to)
+                next_due = self.schedule[0][0] if len(self.schedule) > 0 else now + 0.1
+
+            self.generator.poll()
+            if self.workers == 0:
+                self.generator.drain()
+            self.generator.outbox.send_pending()
+            time.sleep(max(0.0, min(next_due - time.time(), 0.1)))
+        self.generator.questions.stop()
+        for process in processes:
+            # run_workers stops cleanly on SIGTERM
+            process.terminate()
+        for process in processes:
+            process.join()
+
+        return time.time() - start
+
+    # nothing left to post and nothing the bot could still do about it
+    def stalled(self):
+        with self.lock:
+            if len(self.schedule) > 0:
+                return False
+        jobs = self.generator.jobs
+        return jobs.depth('analyze') + jobs.depth('generate') == 0 and \
+            self.generator.db.outbox.count({'status': 'pending'}) == 0
+
+    def report(self, elapsed, out):
+        out.write('%-12s %8s %10s %10s\n' % ('stage', 'count', 'p50 ms', 'p99 ms'))
+        for stage in ['ingest', 'vision', 'analyze', 'sentiment', 'grammar', 'generate', 'mongo', 'send', 'end_to_end']:
+            samples = self.timings.get(stage, [])
+            if len(samples) == 0:
+                continue
+            p50, p99 = percentiles(samples)
+            out.write('%-12s %8d %10.2f %10.2f\n' % (stage, len(samples), p50, p99))
+        out.write('\n%d of %d conversations finished, %d questions in %.1fs (%.2f questions/s)\n' % (
+            self.finished, len(self.scripts), self.sent, elapsed, self.sent / elapsed))
+        if self.workers > 0:
+            # the stages and the question pool ran in the worker processes
+            out.write('jobs worked by %d processes\n' % self.workers)
+        else:
+            pool = self.generator.questions.stats()
+            out.write('question pool: %d hits, %d misses (%.0f%% hit rate)\n' % (
+                pool['hits'], pool['misses'], pool['hit_rate'] * 100))
+        for job in self.generator.db.jobs.find({'status': 'failed'}):
+            out.write('failed: %s (%s)\n' % (job['_id'], job['error']))
+
+# p50 and p99 of a list of durations, in milliseconds
+def percentiles(samples):
+    import numpy as np
+    return np.percentile(np.array(samples) * 1000, [50, 99])
+
+# the bot prints every message it handles, which would bury a report
+def quietly(function, *args, **kwargs):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+
+# modules a run with nothing new shouldn't load
+COLD_START_DEFERRED = ['numpy', 'nltk', 'tracery']
+
+# run in a fresh interpreter, so that nothing is imported or cached yet
+COLD_START = '''
+import json, sys, time
+start = time.time()
+import tweetbot
+imported = time.time()
+import replay
+generator = replay.Replay([], [], 1, 0, 0, %r, 1).generator
+ready = time.time()
+new = generator.anything_new()
+checked = time.time()
+sys.stdout.write(json.dumps({'import': imported - start, 'pass': checked - ready, 'new': new,
+    'loaded': [m for m in replay.COLD_START_DEFERRED if m in sys.modules]}))
+'''
+
+# time importing tweetbot and a first pass that finds nothing new, each in a new process.
+# returns (import seconds, pass seconds, deferred modules that were loaded) for each run.
+def cold_start(runs, mongo):
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', COLD_START % mongo],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(output.splitlines()[-1])
+        results.append((result['import'], result['pass'], result['loaded']))
+    return results
+
+# a conversation as save_conversation would store it, and its vision response
+def seeded_conversation(num_messages, sender_id=None):
+    c = tweetbot.Conversation('http://replay/photo.jpg', sender_id=sender_id)
+    c.user = 'replay'
+    c.num_messages = num_messages
+    c.last_tweet_id = random.getrandbits(62)
+    payload = random.choice(PAYLOADS)
+    features = tweetbot.image_features([payload])[0]
+    for name in ['num_faces', 'num_prominent_faces', 'num_children', 'topics']:
+        setattr(c, name, features[name])
+    c.topic = c.topics[0] if len(c.topics) > 0 else 'default'
+    c.history = ['Why did you take this photo?'] * num_messages
+    document = c.document()
+    document['involved_tweets'] = [random.getrandbits(62) for _ in range(2 * num_messages)]
+    return document, {'_id': c._id, 'details': payload}
+
+# insert conversations, made by make(i) for i in range(count), a thousand at a time
+def seed_conversations(db, count, make):
+    for start in range(0, count, 1000):
+        batch = [make(i) for i in range(start, min(start + 1000, count))]
+        db.conversations.insert_many([b[0] for b in batch])
+        db.image_details.insert_many([b[1] for b in batch])
+
+# time looking up active conversations the way a reply does, with `closed` finished
+# conversations in the collection, then archive those and time the same lookups again
+def compaction_benchmark(closed, mongo, active=100, lookups=500, out=sys.stdout):
+    generator = Replay([], [], 1, 0, 0, mongo, 1).generator
+    db = generator.db
+
+    seed_conversations(db, closed + active, lambda i: seeded_conversation(5 if i < closed else 2))
+    replies = [d['last_tweet_id'] for d in db.conversations.find({'num_messages': {'$lt': 5}}, {'last_tweet_id': 1})]
+
+    def measure():
+        samples = []
+        for _ in range(lookups):
+            last_tweet_id = random.choice(replies)
+            started = time.time()
+            generator.find_conversation({'last_tweet_id': last_tweet_id}, None)
+            samples.append(time.time() - started)
+        return percentiles(samples)
+
+    def size():
+        try:
+            return '%.1f MB' % (db.command('collStats', 'conversations')['size'] / 1e6)
+        except Exception:
+            return 'n/a'
+
+    out.write('%-8s %14s %10s %10s %10s\n' % ('', 'conversations', 'p50 ms', 'p99 ms', 'size'))
+    p50, p99 = measure()
+    out.write('%-8s %14d %10.3f %10.3f %10s\n' % ('before', db.conversations.count(), p50, p99, size()))
+
+    # archiving only takes conversations from before the current second
+    time.sleep(1)
+    generator.archive.min_age = 0
+    started = time.time()
+    archived = generator.archive.compact()
+    elapsed = time.time() - started
+
+    p50, p99 = measure()
+    out.write('%-8s %14d %10.3f %10.3f %10s\n' % ('after', db.conversations.count(), p50, p99, size()))
+    out.write('\narchived %d conversations in %.1fs\n' % (archived, elapsed))
+
+# time find_conversation the way replies look conversations up, by last_tweet_id and by DM
+# sender, over `count` conversations, first without the lookup indexes and then with them.
+# mongomock scans either way, so this needs --mongo to show what the indexes are worth.
+def lookup_benchmark(count, mongo, lookups=500, out=sys.stdout):
+    generator = Replay([], [], 1, 0, 0, mongo, 1).generator
+    db = generator.db
+
+    seed_conversations(db, count, lambda i: seeded_conversation(2, sender_id=i + 1 if i % 2 else None))
+    queries = [{'last_tweet_id': d['last_tweet_id']} if 'sender_id' not in d else {'sender_id': d['sender_id']}
+        for d in db.conversations.find({}, {'last_tweet_id': 1, 'sender_id': 1})]
+
+    def measure():
+        samples = []
+        for _ in range(lookups):
+            query = random.choice(queries)
+            started = time.time()
+            generator.find_conversation(query, None)
+            samples.append(time.time() - started)
+        return percentiles(samples)
+
+    out.write('%-16s %14s %10s %10s\n' % ('', 'conversations', 'p50 ms', 'p99 ms'))
+    db.conversations.drop_indexes()
+    out.write('%-16s %14d %10.3f %10.3f\n' % (('without indexes', count) + tuple(measure())))
+    generator.ensure_indexes()
+    out.write('%-16s %14d %10.3f %10.3f\n' % (('with indexes', count) + tuple(measure())))
+
+# how get_question picked a question before expand_constrained: expand, and start over if the
+# question uses an eliminated rule, switching to #origin# after five tries. it never gave up,
+# so this does after `limit` expansions. returns (rules used or None, expansions).
+def rejection_sample(generator, rule, eliminated, limit=1000):
+    tries = 0
+    for expansions in range(1, limit + 1):
+        used = list(generator.one_time_rules(generator.grammar.expand(rule)))
+        if not set(used) & eliminated:
+            return used, expansions
+        tries += 1
+        if tries > 5:
+            rule = '#origin#'
+    return None, limit
+
+# play `count` conversations of each length through both ways of picking questions, starting
+# from a random topic, and count the grammar expansions each question took
+def expansions_benchmark(count, mongo, lengths=(4, 20), out=sys.stdout):
+    generator = Replay([], [], 1, 0, 0, mongo, 1).generator
+    points = sorted(set(tweetbot.TOPIC_EXPANSIONS.values()))
+
+    out.write('%-10s %-20s %10s %10s %10s %10s\n' % ('questions', '', 'mean', 'max', 'gave up', 'ms/question'))
+    for length in lengths:
+        old = []
+        new = []
+        old_time = new_time = 0.0
+        gave_up = 0
+        for _ in range(count):
+            point = random.choice(points)
+
+            eliminated = set()
+            started = time.time()
+            for _ in range(length):
+                used, expansions = rejection_sample(generator, point, eliminated)
+                old.append(expansions)
+                if used is None:
+                    gave_up += 1
+                    break
+                eliminated |= set(used)
+            old_time += time.time() - started
+
+            mask = 0
+            started = time.time()
+            for _ in range(length):
+                question = generator.expand_question(point, mask)
+                if question is None:
+                    question = generator.expand_question('#origin#', mask)
+                new.append(1 if question is not None else 0)
+                if question is None:
+                    break
+                mask |= generator.rule_bits.mask(question[1])
+            new_time += time.time() - started
+
+        for name, samples, elapsed, failed in [('rejection sampling', old, old_time, gave_up),
+                ('expand_constrained', new, new_time, 0)]:
+            out.write('%-10d %-20s %10.2f %10d %10d %10.3f\n' % (length, name, float(sum(samples)) / len(samples),
+                max(samples), failed, elapsed * 1000 / len(samples)))
+
+# the recursive walk get_question used before one_time_rules, kept to compare against
+def flatten_grammar(node):
+    if node.type != 0:
+        return [node] + reduce(lambda x, y: x + flatten_grammar(y), node.children, [])
+    return [node]
+
+# expand every expansion point of the real question grammar `count` times in all, and time
+# listing the one-time rules each tree used with the old recursive walk and with
+# one_time_rules. fails if the two ever disagree.
+def one_time_rules_benchmark(count, mongo, out=sys.stdout):
+    generator = Replay([], [], 1, 0, 0, mongo, 1).generator
+    points = sorted(tweetbot.EXPANSION_POINTS)
+    trees = [generator.grammar.expand(points[i % len(points)]) for i in range(count)]
+
+    recursive = []
+    iterative = []
+    for tree in trees:
+        started = time.time()
+        old = [c.raw for c in flatten_grammar(tree) if c.type == 1 and c.raw[0].isupper()]
+        recursive.append(time.time() - started)
+
+        started = time.time()
+        new = list(generator.one_time_rules(tree))
+        iterative.append(time.time() - started)
+
+        if old != new:
+            raise AssertionError('%s: %r != %r' % (tree.finished_text, old, new))
+
+    out.write('%-16s %8s %10s %10s\n' % ('', 'trees', 'p50 us', 'p99 us'))
+    for name, samples in [('flatten_grammar', recursive), ('one_time_rules', iterative)]:
+        p50, p99 = percentiles(samples)
+        out.write('%-16s %8d %10.1f %10.1f\n' % (name, count, p50 * 1000, p99 * 1000))
+    out.write('\nboth listed the same rules for every tree\n')
+
+# what scoring a reply costs with a new SentimentIntensityAnalyzer for every call, the way
+# confirmed() used to work, against the shared analyzer, one reply at a time and in a batch
+def sentiment_benchmark(calls, mongo, out=sys.stdout):
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer
+    generator = Replay([], [], 1, 0, 0, mongo, 1).generator
+    texts = [random.choice(REPLIES) for _ in range(calls)]
+
+    fresh = []
+    for text in texts:
+        started = time.time()
+        SentimentIntensityAnalyzer().polarity_scores(text)['compound'] > 0
+        fresh.append(time.time() - started)
+
+    started = time.time()
+    generator.confirmed(texts[0])
+    first = time.time() - started
+
+    shared = []
+    for text in texts:
+        started = time.time()
+        generator.confirmed(text)
+        shared.append(time.time() - started)
+
+    started = time.time()
+    generator.confirmed_many(texts)
+    batch = (time.time() - started) / calls
+
+    out.write('%-22s %8s %10s %10s\n' % ('', 'calls', 'p50 ms', 'p99 ms'))
+    out.write('%-22s %8d %10.3f %10.3f\n' % (('new analyzer per call', calls) + tuple(percentiles(fresh))))
+    out.write('%-22s %8d %10.3f %10.3f\n' % (('shared analyzer', calls) + tuple(percentiles(shared))))
+    out.write('%-22s %8d %10.3f %10s\n' % ('shared, in one batch', calls, batch * 1000, ''))
+    out.write('\nthe shared analyzer took %.1f ms to create on its first call\n' % (first * 1000))
+
+def synthetic_scripts(count, dm_share, payloads):
+    scripts = []
+    for i in range(count):
+        scripts.append({
+            'kind': 'dm' if random.random() < dm_share else 'tweet',
+            'replies': [random.choice(REPLIES) for _ in range(3)],
+            'payload': random.choice(payloads)})
+    return scripts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--conversations', type=int, default=100, help='synthetic conversations to play')
+    parser.add_argument('--recorded', help='JSON file of recorded conversations to play instead')
+    parser.add_argument('--payloads', help='JSON file of recorded vision API responses')
+    parser.add_argument('--dm-share', type=float, default=0.3, help='fraction of synthetic conversations held over DM')
+    parser.add_argument('--rate', type=float, default=10, help='new conversations per second')
+    parser.add_argument('--think', type=float, default=0.5, help='mean seconds before a user answers a question')
+    parser.add_argument('--vision-latency', type=float, default=0.3, help='mean seconds per vision API call')
+    parser.add_argument('--threads', type=int, default=4, help='QuestionGenerator threads')
+    parser.add_argument('--workers', type=int, default=0, help='work jobs in this many processes (needs --mongo)')
+    parser.add_argument('--mongo', help='host:port of a mongod to use instead of mongomock')
+    parser.add_argument('--timeout', type=float, default=600, help='give up after this many seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="keep the bot's own output")
+    parser.add_argument('--cold-start', type=int, metavar='RUNS', help='time this many idle cron runs instead')
+    parser.add_argument('--compaction', type=int, metavar='CONVERSATIONS', help='benchmark lookups before and after archiving this many')
+    parser.add_argument('--lookups', type=int, metavar='CONVERSATIONS', help='benchmark lookups among this many conversations')
+    parser.add_argument('--expansions', type=int, metavar='CONVERSATIONS', help='benchmark expansions per question')
+    parser.add_argument('--one-time-rules', type=int, metavar='TREES', help='benchmark walking this many expansions')
+    parser.add_argument('--sentiment', type=int, metavar='CALLS', help='benchmark scoring this many replies')
+    parser.add_argument('--cold-start-budget', type=float, help='with --cold-start, fail if the median run takes longer (ms)')
+    args = parser.parse_args()
+    if args.workers > 0 and args.mongo is None:
+        parser.error('--workers needs --mongo, since the worker processes have to share a database')
+
+    if args.cold_start:
+        results = cold_start(args.cold_start, args.mongo)
+        imports = sorted(r[0] * 1000 for r in results)
+        passes = sorted(r[1] * 1000 for r in results)
+        loaded = sorted(set(m for r in results for m in r[2]))
+        print 'import tweetbot  median %8.1f ms  max %8.1f ms' % (imports[len(imports) // 2], imports[-1])
+        print 'idle pass        median %8.1f ms  max %8.1f ms' % (passes[len(passes) // 2], passes[-1])
+        failed = False
+        if len(loaded) > 0:
+            print 'FAIL: an idle run loaded ' + ', '.join(loaded)
+            failed = True
+        total = imports[len(imports) // 2] + passes[len(passes) // 2]
+        if args.cold_start_budget is not None and total > args.cold_start_budget:
+            print 'FAIL: %.1f ms is over the %.1f ms budget' % (total, args.cold_start_budget)
+            failed = True
+        raise SystemExit(1 if failed else 0)
+
+    if args.compaction:
+        quietly(compaction_benchmark, args.compaction, args.mongo, out=sys.stdout)
+        raise SystemExit
+
+    if args.lookups:
+        quietly(lookup_benchmark, args.lookups, args.mongo, out=sys.stdout)
+        raise SystemExit
+
+    if args.expansions:
+        quietly(expansions_benchmark, args.expansions, args.mongo, out=sys.stdout)
+        raise SystemExit
+
+    if args.one_time_rules:
+        quietly(one_time_rules_benchmark, args.one_time_rules, args.mongo, out=sys.stdout)
+        raise SystemExit
+
+    if args.sentiment:
+        quietly(sentiment_benchmark, args.sentiment, args.mongo, out=sys.stdout)
+        raise SystemExit
+
+    random.seed(args.seed)
+    payloads = PAYLOADS
+    if args.payloads:
+        with open(args.payloads) as payload_file:
+            payloads = json.load(payload_file)
+    if args.recorded:
+        with open(args.recorded) as recorded_file:
+            scripts = json.load(recorded_file)
+        for script in scripts:
+            script['replies'] = list(script['replies'])[:3]
+            script.setdefault('payload', random.choice(payloads))
+    else:
+        scripts = synthetic_scripts(args.conversations, args.dm_share, payloads)
+
+    replay = Replay(scripts, [s['payload'] for s in scripts], args.rate, args.think, args.vision_latency, args.mongo, args.threads,
+        args.workers)
+
+    elapsed = replay.run(args.timeout) if args.verbose else quietly(replay.run, args.timeout)
+    replay.report(elapsed, sys.stdout)
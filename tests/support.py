@@ -0,0 +1,50 @@
+# Shared setup for the tests. They run against mongomock and the same stand-ins for Twitter
+# and the Computer Vision API that replay.py uses, so they need neither a network nor a mongod.
+# From the top of the repo:
+#
+#   python -m unittest discover tests
+
+import BaseHTTPServer
+import SocketServer
+import threading
+
+import replay
+
+# a QuestionGenerator on a fresh mongomock database, with nothing queued
+def make_generator(payloads=replay.PAYLOADS, threads=1):
+    return replay.quietly(replay.Replay, [], payloads, 1, 0, 0, None, threads).generator
+
+# a local HTTP server for the client code to talk to. every request is handed to
+# respond(handler), which writes the whole response. use it in a with block; url is its address.
+class LocalServer():
+    def __init__(self, respond):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                respond(self)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                respond(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/'
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # the client hanging up partway through a response is often the point of the test
+    def handle_error(self, request, client_address):
+        pass
@@ -0,0 +1,13 @@
+import unittest
+
+import replay
+
+class ColdStartTest(unittest.TestCase):
+    # a pass with nothing new to do shouldn't pay for importing what only questions need
+    def test_first_empty_pass_loads_nothing_deferred(self):
+        [(imported, checked, loaded)] = replay.cold_start(1, None)
+        self.assertEqual(loaded, [], 'loaded on a cold start: ' + ', '.join(loaded))
+        self.assertGreater(imported, 0)
+
+if __name__ == '__main__':
+    unittest.main()
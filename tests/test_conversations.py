@@ -0,0 +1,146 @@
+import datetime
+import unittest
+
+import bson
+
+import replay
+import tweetbot
+from support import make_generator
+
+class LegacyConversationTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = make_generator()
+        self.used = sorted(self.generator.generator_one_time_rules)[:3]
+        self.generator.db.conversations.insert_one({'_id': 'c1', 'image': 'http://replay/0.jpg', 'sender_id': 42,
+            'num_messages': 4, 'history': [], 'involved_tweets': [], 'eliminated_expansions': self.used,
+            'image_details': replay.PAYLOADS[0]})
+
+    def test_excuse_writes_the_mask_before_dropping_the_list(self):
+        conversation = self.generator.find_conversation({'sender_id': 42}, 'dm:42')
+        before = self.generator.snapshot(conversation)
+        conversation.num_messages += 1
+        self.generator.save_conversation(conversation, before)
+
+        document = self.generator.db.conversations.find_one({'_id': 'c1'})
+        self.assertNotIn('eliminated_expansions', document)
+        self.assertNotIn('image_details', document)
+        self.assertEqual(int(document['eliminated'], 16), self.generator.rule_bits.mask(self.used))
+        self.assertEqual(document['num_messages'], 5)
+        self.assertEqual(self.generator.db.image_details.find_one({'_id': 'c1'})['details'], replay.PAYLOADS[0])
+
+class ConversationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = make_generator()
+        self.cache = self.generator.conversations
+        self.twitter = self.generator.outbox.twitter
+        self.replies = []
+        self.twitter.on_reply = lambda kind, target, message: self.replies.append(message.id)
+
+    def run_once(self):
+        replay.quietly(self.generator.poll)
+        replay.quietly(self.generator.drain)
+        replay.quietly(self.generator.outbox.send_pending)
+
+    def test_new_dm_photo_discards_the_old_conversation(self):
+        self.twitter.dm(42, 'hi', media='http://replay/0.jpg')
+        self.run_once()
+        old = self.generator.db.conversations.find_one({'sender_id': 42})
+        self.assertEqual(self.cache.get('dm:42')._id, old['_id'])
+
+        # a photo that can't be analyzed still retires the old conversation, without starting one
+        photo = self.twitter.dm(42, 'another', media='http://replay/1.jpg')
+        replay.quietly(self.generator.process_dm, photo, vision_error='HTTP 400')
+        self.assertEqual(self.generator.db.conversations.find_one({'_id': old['_id']})['sender_id'], -42)
+        self.assertIsNone(self.cache.get('dm:42'))
+        self.assertNotIn(old['_id'], self.cache.keys)
+        self.assertIsNone(self.generator.find_conversation({'sender_id': 42}, 'dm:42'))
+
+    def test_sent_rekeys_a_tweet_conversation(self):
+        self.twitter.mention('someone', '@reflect_bot hi', media='http://replay/0.jpg')
+        replay.quietly(self.generator.poll)
+        replay.quietly(self.generator.drain)
+
+        # generated but not sent: held under its _id, since there is no reply id to key it by yet
+        document = self.generator.db.conversations.find_one()
+        self.assertEqual(self.cache.keys[document['_id']], document['_id'])
+        self.assertIn(document['_id'], self.cache.entries)
+
+        replay.quietly(self.generator.outbox.send_pending)
+        key = 'tweet:' + str(self.replies[0])
+        self.assertEqual(self.cache.keys[document['_id']], key)
+        self.assertNotIn(document['_id'], self.cache.entries)
+        self.assertEqual(self.cache.get(key).last_tweet_id, self.replies[0])
+
+    def test_fifth_message_drops_the_entry(self):
+        self.twitter.dm(42, 'hi', media='http://replay/0.jpg')
+        self.run_once()
+        for _ in range(4):
+            self.assertIsNotNone(self.cache.get('dm:42'))
+            self.twitter.dm(42, 'yes it is me')
+            self.run_once()
+        document = self.generator.db.conversations.find_one({'sender_id': 42})
+        self.assertEqual(document['num_messages'], 5)
+        self.assertIsNone(self.cache.get('dm:42'))
+        self.assertNotIn(document['_id'], self.cache.keys)
+
+    def test_retain_drops_shards_handed_to_another_process(self):
+        unsent = tweetbot.Conversation('http://replay/0.jpg')
+        self.cache.put(None, unsent)
+        for sender_id in range(1, 41):
+            self.cache.put('dm:' + str(sender_id), tweetbot.Conversation('http://replay/0.jpg', sender_id=sender_id))
+        owned = set(range(0, tweetbot.NUM_SHARDS, 2))
+
+        self.generator.shards_changed(list(owned))
+        kept = [key for key in self.cache.entries if key != unsent._id]
+        self.assertTrue(0 < len(kept) < 40)
+        for sender_id in range(1, 41):
+            key = 'dm:' + str(sender_id)
+            self.assertEqual(key in self.cache.entries, tweetbot.shard_of(key) in owned)
+        self.assertEqual(sorted(self.cache.keys.values()), sorted(self.cache.entries))
+        # a conversation still waiting on its reply has no key yet, and stays
+        self.assertIn(unsent._id, self.cache.entries)
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = make_generator()
+        self.db = self.generator.db
+        # name, messages, sender, days since it started, days since its last message
+        for name, num_messages, sender_id, age, idle in [('finished', 5, None, 2, 2), ('retired', 2, -3, 3, 3),
+                ('active', 2, 7, 10, 1), ('young', 5, None, 0, 0), ('abandoned', 3, None, 9, 8)]:
+            now = datetime.datetime.utcnow()
+            document = {'_id': bson.ObjectId.from_datetime(now - datetime.timedelta(days=age)), 'name': name,
+                'image': 'http://replay/0.jpg', 'num_messages': num_messages, 'history': [],
+                'last_active': now - datetime.timedelta(days=idle)}
+            if sender_id is not None:
+                document['sender_id'] = sender_id
+            self.db.conversations.insert_one(document)
+
+    def test_moves_only_old_closed_conversations(self):
+        self.assertEqual(replay.quietly(self.generator.archive.compact), 3)
+        self.assertEqual(sorted(d['name'] for d in self.db.conversations.find()), ['active', 'young'])
+        self.assertEqual(self.generator.archive.find({'sender_id': -3})['name'], 'retired')
+        archived = [tweetbot.ConversationArchive.unpack(e) for e in self.db.archived_conversations.find()]
+        self.assertEqual(sorted(d['name'] for d in archived), ['abandoned', 'finished', 'retired'])
+
+    def test_idle_cutoff_is_configurable(self):
+        archive = tweetbot.ConversationArchive(self.db, idle_after=12*60*60, verbose=False)
+        self.assertEqual(archive.compact(), 4)
+        self.assertEqual([d['name'] for d in self.db.conversations.find()], ['young'])
+
+    def test_saving_marks_a_conversation_active(self):
+        conversation = tweetbot.Conversation('http://replay/0.jpg')
+        before = self.generator.snapshot(conversation)
+        self.generator.save_conversation(conversation, before)
+        saved = self.db.conversations.find_one({'_id': conversation._id})['last_active']
+        self.assertLess(datetime.datetime.utcnow() - saved, datetime.timedelta(seconds=5))
+
+    # mongomock leaves partialFilterExpression out of index_information, so only the keys are checked
+    def test_closed_conversations_are_indexed_by_age(self):
+        self.generator.archive
+        indexes = self.db.conversations.index_information()
+        self.assertEqual(indexes['finished_by_age']['key'], [('_id', 1), ('num_messages', 1)])
+        self.assertEqual(indexes['retired_by_age']['key'], [('_id', 1), ('sender_id', 1)])
+        self.assertEqual(indexes['abandoned_by_activity']['key'], [('last_active', 1), ('num_messages', 1)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import random
+import unittest
+
+import tweetbot
+
+def payload(tags, faces=[]):
+    return {'tags': [{'name': name, 'confidence': confidence} for name, confidence in tags],
+        'faces': faces, 'metadata': {'height': 1000, 'width': 1000}}
+
+class ImageFeaturesTest(unittest.TestCase):
+    def test_topics_come_from_the_best_tier_in_tier_order(self):
+        features = tweetbot.image_features([payload([('outdoor', 0.9), ('food', 0.8), ('dog', 0.7), ('city', 0.9)])])
+        self.assertEqual(features[0]['topics'], ['dog', 'food'])
+
+    def test_repeated_tags_are_one_topic(self):
+        features = tweetbot.image_features([payload([('food', 0.9), ('dog', 0.8), ('food', 0.7), ('dog', 0.95)])])
+        self.assertEqual(features[0]['topics'], ['dog', 'food'])
+
+    def test_unconfident_tags_are_ignored(self):
+        features = tweetbot.image_features([payload([('dog', 0.3), ('mountain', 0.9), ('mountain', 0.8)]), payload([('wall', 0.9)])])
+        self.assertEqual([f['topics'] for f in features], [['mountain'], []])
+
+    def test_prominent_face_adds_people(self):
+        face = {'age': 30, 'faceRectangle': {'height': 400, 'width': 400}}
+        features = tweetbot.image_features([payload([('city', 0.9)], faces=[face]), payload([('dog', 0.9), ('dog', 0.9)], faces=[face])])
+        self.assertEqual([f['topics'] for f in features], [['people'], ['dog', 'people']])
+        self.assertEqual(features[0]['num_prominent_faces'], 1)
+
+    def test_single_photo_matches_the_batch(self):
+        random.seed(18)
+        names = [tag for tier in tweetbot.TOPIC_TIERS for tag in tier] + ['wall', 'sky']
+        payloads = []
+        for _ in range(300):
+            faces = [{'age': random.randint(1, 80), 'faceRectangle': {'height': random.randint(10, 600), 'width': random.randint(10, 600)}}
+                for _ in range(random.randint(0, 4))]
+            tags = [(random.choice(names), random.random()) for _ in range(random.randint(0, 6))]
+            payloads.append(payload(tags, faces=faces))
+
+        batch = tweetbot.image_features(payloads)
+        for p, features in zip(payloads, batch):
+            single = tweetbot.image_features([p])[0]
+            self.assertEqual(single, tweetbot.photo_features(p))
+            self.assertEqual(single['topics'], features['topics'])
+            for name in ['num_faces', 'num_prominent_faces', 'num_children']:
+                self.assertEqual(single[name], features[name])
+            for a, b in zip(single['face_sizes'], features['face_sizes']):
+                self.assertAlmostEqual(a, b)
+
+if __name__ == '__main__':
+    unittest.main()
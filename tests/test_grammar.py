@@ -0,0 +1,75 @@
+import os
+import random
+import threading
+import unittest
+
+import replay
+import tweetbot
+from support import make_generator
+
+class ConstrainedExpansionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.generator = make_generator()
+        cls.rules = sorted(cls.generator.generator_one_time_rules)
+
+    def test_never_uses_an_eliminated_rule(self):
+        random.seed(8)
+        for _ in range(200):
+            eliminated = set(random.sample(self.rules, random.randint(0, len(self.rules))))
+            mask = self.generator.rule_bits.mask(eliminated)
+            for point in tweetbot.EXPANSION_POINTS:
+                expansion = self.generator.expand_constrained(point, eliminated)
+                if expansion is not None:
+                    self.assertFalse(set(self.generator.one_time_rules(expansion)) & eliminated)
+                question = self.generator.expand_question(point, mask)
+                if question is not None:
+                    self.assertFalse(set(question[1]) & eliminated)
+
+    def test_exhausted_origin_returns_none(self):
+        eliminated = self.generator.generator_reachable['origin']
+        self.assertIsNone(self.generator.expand_constrained('#origin#', eliminated))
+        self.assertIsNone(self.generator.expand_question('#origin#', self.generator.rule_bits.mask(eliminated)))
+
+    def test_get_question_falls_back_to_an_excuse(self):
+        conversation = tweetbot.Conversation('http://replay/0.jpg')
+        conversation.topics = ['dog']
+        conversation.num_messages = 1
+        conversation.eliminated = self.generator.rule_bits.mask(self.rules)
+
+        # the old rejection sampling never returned here, so give up on it rather than hang
+        result = []
+        thread = threading.Thread(target=lambda: result.append(replay.quietly(self.generator.get_question, conversation)))
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertIn(result[0][0], self.generator.conversation_excuses)
+        self.assertEqual(result[0][1].num_messages, 2)
+
+class CheckGrammarTest(unittest.TestCase):
+    def check(self, rules, entry_points=['#origin#']):
+        grammar = tweetbot.compile_grammar(rules)
+        grammar['rules'] = rules
+        return tweetbot.check_grammar(grammar, entry_points)
+
+    def test_clean_grammar(self):
+        self.assertEqual(self.check({'origin': ['#Why#'], 'Why': ['Why?']}), ([], []))
+
+    def test_unreachable_symbol_is_only_a_warning(self):
+        errors, warnings = self.check({'origin': ['#Why#'], 'Why': ['Why?'], 'Where': ['Where?']})
+        self.assertEqual(errors, [])
+        self.assertEqual(warnings, ['Where: unreachable from every entry point'])
+
+    def test_unbalanced_and_undefined_are_errors(self):
+        errors, warnings = self.check({'origin': ['#Why#', '#When'], 'Why': ['#Who# why?']})
+        self.assertEqual(errors, ['Why: refers to undefined #Who#', 'origin: unbalanced # in "#When"'])
+        self.assertEqual(warnings, [])
+
+    def test_bundled_grammars_have_no_errors(self):
+        for name, entry_points in [('questions.json', tweetbot.EXPANSION_POINTS), ('prompts.json', ['#origin#'])]:
+            grammar = tweetbot.load_grammar(os.path.join(tweetbot.GRAMMAR_DIR, name))
+            self.assertEqual(tweetbot.check_grammar(grammar, entry_points)[0], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import datetime
+import unittest
+
+import replay
+import tweetbot
+from support import make_generator
+
+# a vision API that turns every photo down
+class RejectingVision(object):
+    def __init__(self):
+        self.calls = 0
+
+    def analyze(self, body, content_type):
+        self.calls += 1
+        raise tweetbot.VisionError('HTTP 400: InvalidImageSize')
+
+# a vision API in an outage that ends after down calls
+class UnavailableVision(object):
+    cooldown = 60
+
+    def __init__(self, down):
+        self.down = down
+        self.calls = 0
+
+    def analyze(self, body, content_type):
+        self.calls += 1
+        if self.calls <= self.down:
+            raise tweetbot.VisionUnavailable('circuit open after repeated failures')
+        return replay.PAYLOADS[0]
+
+class AnalyzeFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = make_generator()
+        self.generator.vision = RejectingVision()
+        self.twitter = self.generator.outbox.twitter
+        self.replies = []
+        self.twitter.on_reply = lambda kind, target, message: self.replies.append((kind, target))
+
+    def run_once(self):
+        replay.quietly(self.generator.poll)
+        replay.quietly(self.generator.drain)
+        replay.quietly(self.generator.outbox.send_pending)
+
+    def assert_photo_prompt(self, kind, target):
+        self.assertEqual(self.generator.vision.calls, 1)
+        self.assertEqual(self.replies, [(kind, target)])
+        self.assertEqual(self.generator.db.conversations.count(), 0)
+
+    def test_tweet_gets_a_photo_prompt_without_asking_again(self):
+        status = self.twitter.mention('someone', '@reflect_bot hi', media='http://replay/0.jpg')
+        self.run_once()
+        self.assert_photo_prompt('tweet', status.id)
+
+    def test_dm_gets_a_photo_prompt_without_asking_again(self):
+        self.twitter.dm(42, 'hi', media='http://replay/0.jpg')
+        self.run_once()
+        self.assert_photo_prompt('dm', 42)
+
+class VisionOutageTest(unittest.TestCase):
+    def test_outage_defers_without_using_up_attempts(self):
+        generator = make_generator()
+        generator.vision = UnavailableVision(down=10)
+        replies = []
+        generator.outbox.twitter.on_reply = lambda kind, target, message: replies.append(target)
+        status = generator.outbox.twitter.mention('someone', '@reflect_bot hi', media='http://replay/0.jpg')
+        replay.quietly(generator.poll)
+
+        job_id = 'analyze:tweet:' + str(status.id)
+        for _ in range(10):
+            replay.quietly(generator.drain)
+            job = generator.db.jobs.find_one({'_id': job_id})
+            self.assertEqual(job['status'], 'ready')
+            self.assertEqual(job['attempts'], 0)
+            self.assertGreater(job['available_at'], datetime.datetime.utcnow() + datetime.timedelta(seconds=50))
+            # the cooldown passes
+            generator.db.jobs.update_one({'_id': job_id}, {'$set': {'available_at': datetime.datetime.utcnow()}})
+        self.assertEqual(generator.vision.calls, 10)
+
+        replay.quietly(generator.drain)
+        replay.quietly(generator.outbox.send_pending)
+        self.assertEqual(generator.db.jobs.find_one({'_id': job_id})['status'], 'done')
+        self.assertEqual(replies, [status.id])
+
+if __name__ == '__main__':
+    unittest.main()
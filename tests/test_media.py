@@ -0,0 +1,78 @@
+import io
+import time
+import unittest
+
+import replay
+import tweetbot
+from support import LocalServer, make_generator
+
+def send(handler, status, body, length=True, headers={}):
+    handler.send_response(status)
+    if length:
+        handler.send_header('Content-Length', str(len(body)))
+    for name, value in headers.items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(body)
+
+class DownloadDMMediaTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.generator = make_generator()
+        # replay.py stubs the download out; these tests want the real one
+        del cls.generator.download_dm_media
+
+    def setUp(self):
+        self.limits = tweetbot.MAX_MEDIA_BYTES, tweetbot.MEDIA_DEADLINE
+
+    def tearDown(self):
+        tweetbot.MAX_MEDIA_BYTES, tweetbot.MEDIA_DEADLINE = self.limits
+
+    def test_returns_the_body(self):
+        with LocalServer(lambda handler: send(handler, 200, 'photo')) as server:
+            self.assertEqual(self.generator.download_dm_media(server.url), 'photo')
+
+    def test_content_length_over_the_cap(self):
+        tweetbot.MAX_MEDIA_BYTES = 1000
+        with LocalServer(lambda handler: send(handler, 200, 'x' * 2000)) as server:
+            self.assertRaises(tweetbot.VisionError, self.generator.download_dm_media, server.url)
+
+    def test_stream_over_the_cap(self):
+        # no Content-Length, so the cap can only be noticed while reading
+        tweetbot.MAX_MEDIA_BYTES = 100 * 1024
+        with LocalServer(lambda handler: send(handler, 200, 'x' * 300 * 1024, length=False)) as server:
+            self.assertRaises(tweetbot.VisionError, self.generator.download_dm_media, server.url)
+
+    def test_deadline(self):
+        def trickle(handler):
+            handler.send_response(200)
+            handler.end_headers()
+            for _ in range(20):
+                handler.wfile.write('x' * 64 * 1024)
+                handler.wfile.flush()
+                time.sleep(0.1)
+
+        tweetbot.MEDIA_DEADLINE = 0.3
+        with LocalServer(trickle) as server:
+            start = time.time()
+            self.assertRaises(IOError, self.generator.download_dm_media, server.url)
+            self.assertLess(time.time() - start, 1.5)
+
+    def test_permanent_client_error(self):
+        with LocalServer(lambda handler: send(handler, 403, 'expired')) as server:
+            self.assertRaises(tweetbot.VisionError, self.generator.download_dm_media, server.url)
+
+    def test_server_error_is_not_the_photo(self):
+        with LocalServer(lambda handler: send(handler, 503, 'busy')) as server:
+            self.assertRaises(tweetbot.requests.HTTPError, self.generator.download_dm_media, server.url)
+
+    @unittest.skipIf(tweetbot.Image is None, 'Pillow is not installed')
+    def test_downscales_a_large_photo(self):
+        photo = io.BytesIO()
+        tweetbot.Image.new('RGB', (4000, 3000), (200, 120, 40)).save(photo, 'JPEG')
+        with LocalServer(lambda handler: send(handler, 200, photo.getvalue())) as server:
+            body = replay.quietly(self.generator.downscale_image, self.generator.download_dm_media(server.url))
+        self.assertEqual(tweetbot.Image.open(io.BytesIO(body)).size, (1600, 1200))
+
+if __name__ == '__main__':
+    unittest.main()
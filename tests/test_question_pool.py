@@ -0,0 +1,129 @@
+import collections
+import math
+import random
+import unittest
+
+import tweetbot
+from support import make_generator
+
+# Pearson's chi-square test that two samples of categories come from the same distribution.
+# categories expected fewer than 5 times are pooled so the approximation holds. returns the
+# statistic and its degrees of freedom.
+def chi_square(a, b):
+    total_a, total_b = float(sum(a.values())), float(sum(b.values()))
+    cells = [(a[c], b[c]) for c in set(a) | set(b)]
+    common = [cell for cell in cells if min(sum(cell) * total_a, sum(cell) * total_b) / (total_a + total_b) >= 5]
+    rare = [cell for cell in cells if cell not in common]
+    if len(rare) > 0:
+        common.append((sum(x for x, _ in rare), sum(y for _, y in rare)))
+
+    statistic = 0.0
+    for x, y in common:
+        n = x + y
+        expected_a, expected_b = n * total_a / (total_a + total_b), n * total_b / (total_a + total_b)
+        statistic += (x - expected_a) ** 2 / expected_a + (y - expected_b) ** 2 / expected_b
+    return statistic, len(common) - 1
+
+# the chi-square value a statistic has a 0.1% chance of exceeding by luck, by the
+# Wilson-Hilferty approximation
+def critical_value(df, z=3.09):
+    return df * (1 - 2.0 / (9 * df) + z * math.sqrt(2.0 / (9 * df))) ** 3
+
+class QuestionPoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.generator = make_generator()
+
+    def sample_pool(self, rule, eliminated, count):
+        pool = tweetbot.QuestionPool(self.generator.expand_question, self.generator.rule_scope,
+            self.generator.remaining_options, size=4, verbose=False)
+        pool.running = True
+        mask = self.generator.rule_bits.mask(eliminated)
+        counts = collections.Counter()
+        for _ in range(count):
+            counts[tuple(sorted(pool.take(rule, mask)[1]))] += 1
+            # what the background thread would do between takes
+            pool.refill()
+        self.assertGreater(pool.stats()['hits'], count / 2)
+        return counts
+
+    def sample_direct(self, rule, eliminated, count):
+        counts = collections.Counter()
+        for _ in range(count):
+            expansion = self.generator.expand_constrained(rule, eliminated)
+            counts[tuple(sorted(self.generator.one_time_rules(expansion)))] += 1
+        return counts
+
+    def assert_same_distribution(self, rule, eliminated, count=1500):
+        random.seed(21)
+        pooled = self.sample_pool(rule, eliminated, count)
+        direct = self.sample_direct(rule, eliminated, count)
+        statistic, df = chi_square(pooled, direct)
+        self.assertGreater(df, 0)
+        self.assertLess(statistic, critical_value(df), '%s: chi-square %.1f with %d df' % (rule, statistic, df))
+
+    def test_origin_matches_expand_constrained(self):
+        self.assert_same_distribution('#origin#', set())
+
+    def test_constrained_topic_matches_expand_constrained(self):
+        reachable = sorted(self.generator.generator_reachable['people_group'])
+        self.assert_same_distribution('#people_group#', set(reachable[:len(reachable) // 2]))
+
+    def test_remaining_is_worked_out_once_per_key(self):
+        calls = []
+        def options(rule, eliminated):
+            calls.append((rule, eliminated))
+            return self.generator.remaining_options(rule, eliminated)
+        pool = tweetbot.QuestionPool(self.generator.expand_question, self.generator.rule_scope, options, verbose=False)
+
+        reachable = self.generator.generator_reachable['people_group']
+        outside = self.generator.rule_bits.mask(set(self.generator.generator_one_time_rules) - reachable)
+        for eliminated in [0, outside, 0]:
+            self.assertEqual(pool.remaining('#people_group#', eliminated), reachable)
+        exhausted = self.generator.rule_bits.mask(reachable)
+        for _ in range(2):
+            self.assertIsNone(pool.remaining('#people_group#', exhausted))
+            self.assertIsNone(pool.take('#people_group#', exhausted))
+        self.assertEqual(len(calls), 2)
+
+    def test_only_keys_taken_twice_are_refilled(self):
+        calls = []
+        def expand(rule, eliminated):
+            calls.append((rule, eliminated))
+            return self.generator.expand_question(rule, eliminated)
+        pool = tweetbot.QuestionPool(expand, self.generator.rule_scope, self.generator.remaining_options,
+            size=4, verbose=False)
+        pool.running = True
+
+        pool.take('#origin#', 0)
+        pool.refill()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(pool.stats()['pools'], 0)
+
+        pool.take('#origin#', 0)
+        pool.refill()
+        self.assertEqual(len(calls), 2 + 4)
+        self.assertIsNotNone(pool.take('#origin#', 0))
+        self.assertEqual(pool.stats()['hits'], 1)
+
+    def test_pruned_grammar_is_built_once_per_dead_set(self):
+        reachable = sorted(self.generator.generator_reachable['people_group'])
+        eliminated = set(reachable[:len(reachable) // 2])
+        dead = self.generator.dead_symbols(eliminated)
+        first = self.generator.pruned_grammar(dead)
+        for _ in range(3):
+            self.generator.expand_constrained('#people_group#', eliminated)
+        self.assertIs(self.generator.pruned_grammar(set(dead)), first)
+        self.assertIsNot(self.generator.pruned_grammar(dead - set(reachable[:1])), first)
+
+    def test_chi_square_notices_a_skewed_pool(self):
+        random.seed(21)
+        direct = self.sample_direct('#origin#', set(), 1500)
+        skewed = collections.Counter(direct)
+        common = direct.most_common(1)[0][0]
+        skewed[common] += 300
+        statistic, df = chi_square(skewed, direct)
+        self.assertGreater(statistic, critical_value(df))
+
+if __name__ == '__main__':
+    unittest.main()
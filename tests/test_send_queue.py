@@ -0,0 +1,102 @@
+import datetime
+import unittest
+
+import replay
+import tweetbot
+from support import make_generator
+
+class Crash(Exception):
+    pass
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = make_generator()
+        self.db = self.generator.db
+        self.outbox = self.generator.outbox
+        self.twitter = self.outbox.twitter
+        self.posted = []
+        self.twitter.on_reply = lambda kind, target, message: self.posted.append(message.id)
+        self.db.conversations.insert_one({'_id': 'c1', 'involved_tweets': [], 'last_tweet_id': 5})
+        self.outbox.enqueue('update_status', '@someone hi', 5, 5, 'c1')
+
+    def entry(self):
+        return self.db.outbox.find_one({'_id': self.outbox.reply_id(5)})
+
+    # the lease runs out, as it would once the crashed sender is long gone
+    def expire(self):
+        self.db.outbox.update_one({'_id': self.outbox.reply_id(5)},
+            {'$set': {'lease_until': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)}})
+
+    def send_pending(self):
+        return replay.quietly(self.outbox.send_pending)
+
+    def test_claims_before_posting(self):
+        seen = []
+        update_status = self.twitter.update_status
+        def check(text, in_reply_to_status_id=None):
+            seen.append(self.entry())
+            return update_status(text, in_reply_to_status_id)
+        self.twitter.update_status = check
+
+        self.assertEqual(self.send_pending(), 1)
+        self.assertEqual(seen[0]['status'], 'sending')
+        self.assertGreater(seen[0]['lease_until'], datetime.datetime.utcnow())
+
+        entry = self.entry()
+        self.assertEqual(entry['status'], 'sent')
+        self.assertEqual(entry['response_id'], self.posted[0])
+        self.assertNotIn('lease_until', entry)
+        conversation = self.db.conversations.find_one({'_id': 'c1'})
+        self.assertEqual(conversation['involved_tweets'], [5, self.posted[0]])
+        self.assertEqual(conversation['last_tweet_id'], self.posted[0])
+
+    def test_skips_a_message_another_sender_has(self):
+        message = self.entry()
+        self.assertIsNotNone(self.outbox.claim(message))
+        self.assertFalse(replay.quietly(self.outbox.send, message))
+        self.assertEqual(self.posted, [])
+
+    def test_crash_after_posting_is_finished_without_posting_again(self):
+        finish = self.outbox.finish
+        def crash(message, response_id):
+            raise Crash()
+        self.outbox.finish = crash
+        self.assertRaises(Crash, self.send_pending)
+        self.assertEqual(self.entry()['status'], 'sending')
+        self.assertEqual(self.entry()['response_id'], self.posted[0])
+
+        # a new sender leaves it alone while the lease holds, then finishes it
+        self.outbox.finish = finish
+        self.assertEqual(self.send_pending(), 0)
+        self.assertEqual(self.entry()['status'], 'sending')
+        self.expire()
+        self.send_pending()
+        self.assertEqual(len(self.posted), 1)
+        self.assertEqual(self.entry()['status'], 'sent')
+        self.assertEqual(self.db.conversations.find_one({'_id': 'c1'})['last_tweet_id'], self.posted[0])
+
+    def test_crash_while_posting_is_not_retried(self):
+        def crash(text, in_reply_to_status_id=None):
+            self.posted.append(None)
+            raise Crash()
+        self.twitter.update_status = crash
+        self.assertRaises(Crash, self.send_pending)
+
+        self.expire()
+        self.send_pending()
+        self.assertEqual(self.posted, [None])
+        self.assertEqual(self.entry()['status'], 'failed')
+
+    def test_failed_send_goes_back_to_pending(self):
+        def fail(text, in_reply_to_status_id=None):
+            raise tweetbot.tweepy.TweepError('Failed to send request')
+        self.twitter.update_status = fail
+        self.assertEqual(self.send_pending(), 0)
+
+        entry = self.entry()
+        self.assertEqual(entry['status'], 'pending')
+        self.assertEqual(entry['attempts'], 1)
+        self.assertNotIn('lease_until', entry)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import StringIO
+import json
+import sys
+import threading
+import time
+import unittest
+
+import requests
+
+import tweetbot
+from support import LocalServer
+
+ANALYSIS = {'tags': [{'name': 'dog', 'confidence': 0.9}], 'faces': []}
+
+# a stand-in for the vision API that answers with each status in turn, then the last one forever
+class FlakyAPI():
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.delay = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, handler):
+        with self.lock:
+            self.requests += 1
+            status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        time.sleep(self.delay)
+        body = json.dumps(ANALYSIS) if status == 200 else '{"code": "Busy"}'
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+class VisionClientTest(unittest.TestCase):
+    # the circuit opening is reported on stdout, which would only clutter the test output
+    def setUp(self):
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def client(self, server, retries=3):
+        client = tweetbot.VisionClient('key', requests.Session(), retries=retries, backoff=0.01,
+            max_backoff=0.02, failure_threshold=3, cooldown=0.3, verbose=False)
+        client.uri = server.url
+        return client
+
+    def analyze(self, client):
+        return client.analyze('{"url": "http://example.com/dog.jpg"}', 'application/json')
+
+    def open_circuit(self, client):
+        self.assertRaises(tweetbot.VisionUnavailable, self.analyze, client)
+        self.assertEqual(client.state(), 'open')
+
+    def test_retries_through_flaky_503s(self):
+        api = FlakyAPI(503, 503, 200)
+        with LocalServer(api) as server:
+            client = self.client(server)
+            self.assertEqual(self.analyze(client), ANALYSIS)
+        self.assertEqual(api.requests, 3)
+        self.assertEqual(client.stats()['retried'], 2)
+        self.assertEqual(client.state(), 'closed')
+        self.assertEqual(client.consecutive_failures, 0)
+
+    def test_rejected_image_is_not_retried(self):
+        api = FlakyAPI(400)
+        with LocalServer(api) as server:
+            client = self.client(server)
+            self.assertRaises(tweetbot.VisionError, self.analyze, client)
+        self.assertEqual(api.requests, 1)
+        self.assertEqual(client.state(), 'closed')
+
+    def test_circuit_opens_and_turns_calls_away(self):
+        api = FlakyAPI(503)
+        with LocalServer(api) as server:
+            client = self.client(server)
+            self.open_circuit(client)
+            self.assertEqual(api.requests, 3)
+
+            self.assertRaises(tweetbot.VisionUnavailable, self.analyze, client)
+            self.assertEqual(api.requests, 3)
+            self.assertEqual(client.stats()['rejected'], 1)
+
+    def test_recovers_through_a_single_probe(self):
+        api = FlakyAPI(503, 503, 503, 200)
+        with LocalServer(api) as server:
+            client = self.client(server)
+            self.open_circuit(client)
+            time.sleep(0.35)
+            self.assertEqual(client.state(), 'half-open')
+
+            # while the probe is in flight everyone else is still turned away
+            api.delay = 0.3
+            results = []
+            probe = threading.Thread(target=lambda: results.append(self.analyze(client)))
+            probe.start()
+            time.sleep(0.1)
+            for _ in range(5):
+                self.assertRaises(tweetbot.VisionUnavailable, self.analyze, client)
+            probe.join()
+            self.assertEqual(results, [ANALYSIS])
+            self.assertEqual(api.requests, 4)
+
+            api.delay = 0
+            self.assertEqual(client.state(), 'closed')
+            self.assertEqual(self.analyze(client), ANALYSIS)
+
+    def test_failed_probe_reopens_without_retrying(self):
+        api = FlakyAPI(503)
+        with LocalServer(api) as server:
+            client = self.client(server)
+            self.open_circuit(client)
+            time.sleep(0.35)
+
+            self.assertRaises(tweetbot.VisionUnavailable, self.analyze, client)
+            self.assertEqual(api.requests, 4)
+            self.assertEqual(client.state(), 'open')
+
+    def test_one_failure_after_recovery_keeps_the_circuit_closed(self):
+        api = FlakyAPI(503, 503, 503, 200, 503, 200)
+        with LocalServer(api) as server:
+            client = self.client(server, retries=0)
+            for _ in range(3):
+                self.assertRaises(tweetbot.VisionUnavailable, self.analyze, client)
+            self.assertEqual(client.state(), 'open')
+            time.sleep(0.35)
+            self.assertEqual(self.analyze(client), ANALYSIS)
+
+            self.assertRaises(tweetbot.VisionUnavailable, self.analyze, client)
+            self.assertEqual(client.state(), 'closed')
+            self.assertEqual(self.analyze(client), ANALYSIS)
+
+if __name__ == '__main__':
+    unittest.main()
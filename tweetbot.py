@@ -1,11 +1,35 @@
-import urllib, json, requests
-import tracery
-import tracery.modifiers
-import numpy as np
+import json, requests
+import hashlib
+import datetime
 import tweepy
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
 import pymongo
+import pymongo.errors
+import bson
+import requests.adapters
 import random
+import re
+import signal
+import time
+import argparse
+import BaseHTTPServer
+import threading
+import collections
+import multiprocessing
+import socket
+import zlib
+import os
+import io
+
+# numpy, nltk and tracery are imported where they are first needed instead of up here. the cron
+# job starts a fresh process every minute and most runs find nothing to answer, so it shouldn't
+# pay to load them (nltk alone takes most of a second).
+
+# Pillow is only used to shrink large DM photos before uploading them. without it they are
+# uploaded at full size.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # This conversational twitter bot is running on a 1 minute cron job on the fog.today server,
 # posting tweets from @SnapshotReflect.
@@ -21,231 +45,1439 @@ import random
 #     "Is that your book", etc
 #   - database operations should be more atomic. right now it can put its database in a bad state
 #     if it encounters a Computer Vision API error
-#   - conversation should maybe be its own class?
 #   - ending excuses are funny but need some work
 #   - switch to real logging
 
+# The Tracery grammars live in grammars/*.json. Everything derived from a grammar's source (the
+# symbols each alternative references, the capitalized one-time rules, and which of those each
+# symbol can reach) is compiled into a .compiled.json file next to it, tagged with a hash of the
+# source. A compiled file whose hash doesn't match is rebuilt, so it can never go stale.
+GRAMMAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grammars')
+
+# the symbols referenced by a rule, e.g. "#Return# #Dodifferent#" or "#picture.s#"
+def rule_references(rule):
+    return set(ref.split('.')[0] for ref in re.findall(r'#([^#]+)#', rule))
+
+def compile_grammar(rules):
+    references = dict((symbol, [rule_references(a) for a in alternatives])
+        for symbol, alternatives in rules.items())
+    one_time_rules = set(symbol for symbol in rules if symbol[0].isupper())
+
+    # repeat until nothing changes, since rules can refer to each other in cycles
+    reachable = dict((symbol, set([symbol]) & one_time_rules) for symbol in rules)
+    changed = True
+    while changed:
+        changed = False
+        for symbol in rules:
+            for refs in references[symbol]:
+                for ref in refs:
+                    new = reachable.get(ref, set()) - reachable[symbol]
+                    if len(new) > 0:
+                        reachable[symbol] |= new
+                        changed = True
+
+    return {
+        'references': references,
+        'one_time_rules': one_time_rules,
+        'reachable': reachable}
+
+# which symbols refer to each symbol, the reverse of compile_grammar's references
+def grammar_dependents(references):
+    dependents = dict((symbol, set()) for symbol in references)
+    for symbol, alternatives in references.items():
+        for refs in alternatives:
+            for ref in refs:
+                if ref in dependents:
+                    dependents[ref].add(symbol)
+    return dependents
+
+# problems that would otherwise only show up as odd questions. errors are unbalanced #s and
+# references to symbols that don't exist, which break an expansion. warnings are symbols that
+# can't be reached from any of the entry points: harmless, but a one-time rule among them can
+# never be asked. returns (errors, warnings).
+def check_grammar(grammar, entry_points):
+    rules = grammar['rules']
+    errors = []
+    for symbol in sorted(rules):
+        for alternative in rules[symbol]:
+            if alternative.count('#') % 2 != 0:
+                errors.append('%s: unbalanced # in "%s"' % (symbol, alternative))
+            for ref in sorted(rule_references(alternative) - set(rules)):
+                errors.append('%s: refers to undefined #%s#' % (symbol, ref))
+
+    for entry_point in sorted(entry_points):
+        if entry_point.count('#') % 2 != 0 or len(rule_references(entry_point)) == 0:
+            errors.append('entry point "%s" is malformed' % entry_point)
+        for ref in sorted(rule_references(entry_point) - set(rules)):
+            errors.append('entry point "%s" refers to undefined #%s#' % (entry_point, ref))
+
+    used = set()
+    pending = [ref for entry_point in entry_points for ref in rule_references(entry_point)]
+    while len(pending) > 0:
+        symbol = pending.pop()
+        if symbol in used or symbol not in rules:
+            continue
+        used.add(symbol)
+        for refs in grammar['references'][symbol]:
+            pending.extend(refs)
+    warnings = ['%s: unreachable from every entry point' % symbol for symbol in sorted(set(rules) - used)]
+
+    return errors, warnings
+
+def compiled_grammar_path(path):
+    return os.path.splitext(path)[0] + '.compiled.json'
+
+def save_compiled_grammar(path, source_hash, compiled):
+    with open(compiled_grammar_path(path), 'w') as compiled_file:
+        json.dump({
+            'source_sha1': source_hash,
+            'references': dict((s, [sorted(r) for r in refs]) for s, refs in compiled['references'].items()),
+            'one_time_rules': sorted(compiled['one_time_rules']),
+            'reachable': dict((s, sorted(r)) for s, r in compiled['reachable'].items())}, compiled_file)
+
+def load_compiled_grammar(path, source_hash):
+    try:
+        with open(compiled_grammar_path(path)) as compiled_file:
+            compiled = json.load(compiled_file)
+    except (IOError, ValueError):
+        return None
+
+    if compiled.get('source_sha1') != source_hash:
+        return None
+
+    return {
+        'references': dict((s, [set(r) for r in refs]) for s, refs in compiled['references'].items()),
+        'one_time_rules': set(compiled['one_time_rules']),
+        'reachable': dict((s, set(r)) for s, r in compiled['reachable'].items())}
+
+# load a grammar and its compiled form, rebuilding the compiled file if it is missing or stale
+def load_grammar(path):
+    with open(path) as grammar_file:
+        source = grammar_file.read()
+    source_hash = hashlib.sha1(source).hexdigest()
+    rules = json.loads(source)
+
+    grammar = load_compiled_grammar(path, source_hash)
+    if grammar is None:
+        grammar = compile_grammar(rules)
+        try:
+            save_compiled_grammar(path, source_hash, grammar)
+        except IOError as e:
+            print '! load_grammar | ERROR, could not save compiled grammar: ' + str(e)
+
+    grammar['rules'] = rules
+    grammar['dependents'] = grammar_dependents(grammar['references'])
+    return grammar
+
+# DM photos are downloaded by the bot and uploaded to the vision API. downloads larger than
+# MAX_MEDIA_BYTES or slower than MEDIA_DEADLINE seconds are abandoned, and photos are shrunk to
+# VISION_MAX_DIMENSION on their longest side, which is as much detail as tags and faces need.
+MAX_MEDIA_BYTES = 20 * 1024 * 1024
+MEDIA_TIMEOUT = (5, 30)
+MEDIA_DEADLINE = 60
+VISION_MAX_DIMENSION = 1600
+
+# Timings for each stage of the hot path and counts of how things turned out, exported as
+# Prometheus text (--metrics-port) or a JSON file (--metrics-file). Everything reports to the
+# module's metrics object, which starts out disabled. While it is disabled timer() hands back
+# a shared context that does nothing and count() returns straight away, so instrumented code
+# pays for a function call and nothing else.
+class Metrics():
+    buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30]
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.events = {}
+        self.gauges = {}
+
+    def timer(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(self.buckets)}
+            stats['count'] += 1
+            stats['sum'] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+
+    def count(self, event, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.events[event] = self.events.get(event, 0) + n
+
+    def gauge(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'stages': dict((stage, {
+                    'count': stats['count'],
+                    'sum': stats['sum'],
+                    'mean': stats['sum'] / stats['count'],
+                    'buckets': dict((str(bound), n) for bound, n in zip(self.buckets, stats['buckets']))})
+                    for stage, stats in self.stages.items()),
+                'events': dict(self.events),
+                'gauges': dict(self.gauges)}
+
+    def prometheus(self):
+        with self.lock:
+            lines = ['# TYPE tweetbot_stage_seconds histogram']
+            for stage, stats in sorted(self.stages.items()):
+                for bound, n in zip(self.buckets, stats['buckets']):
+                    lines.append('tweetbot_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, n))
+                lines.append('tweetbot_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (stage, stats['count']))
+                lines.append('tweetbot_stage_seconds_sum{stage="%s"} %f' % (stage, stats['sum']))
+                lines.append('tweetbot_stage_seconds_count{stage="%s"} %d' % (stage, stats['count']))
+            lines.append('# TYPE tweetbot_events_total counter')
+            for event, n in sorted(self.events.items()):
+                lines.append('tweetbot_events_total{event="%s"} %d' % (event, n))
+            for name, value in sorted(self.gauges.items()):
+                lines.append('# TYPE tweetbot_%s gauge' % name)
+                lines.append('tweetbot_%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    # write through a temporary file, so whatever reads it never sees half a file
+    def write_json(self, path):
+        with open(path + '.tmp', 'w') as metrics_file:
+            json.dump(self.snapshot(), metrics_file, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    # serve /metrics for Prometheus to scrape, from a background thread
+    def serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('', port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+class StageTimer():
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.time() - self.start)
+
+class NullTimer():
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_TIMER = NullTimer()
+metrics = Metrics()
+
+# the vision API rejected an image (too big, unreadable, ...), so asking again won't help
+class VisionError(Exception):
+    pass
+
+# the vision API is down or overloaded. the message should be retried on a later run.
+class VisionUnavailable(Exception):
+    pass
+
+# Client for the Microsoft Computer Vision API. Calls share a keep-alive session and are
+# retried with jittered exponential backoff, within an overall deadline. After
+# failure_threshold failures in a row the circuit opens and calls fail straight away with
+# VisionUnavailable for cooldown seconds, so messages are deferred rather than hammering an
+# unhealthy API. Then the circuit is half-open: a single call is let through as a probe, without
+# retries, while every other call is still turned away. The probe succeeding closes the circuit
+# and failing opens it for another cooldown.
+class VisionClient():
+    uri = 'https://westcentralus.api.cognitive.microsoft.com/vision/v1.0/analyze'
+
+    def __init__(self, subscription_key, session, retries=3, timeout=10, deadline=30, backoff=0.5,
+            max_backoff=8, failure_threshold=5, cooldown=60, verbose=True):
+        self.subscription_key = subscription_key
+        self.session = session
+        self.retries = retries
+        self.timeout = timeout
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = None
+        self.probing = False
+
+        self.calls = 0
+        self.errors = 0
+        self.retried = 0
+        self.rejected = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def state(self):
+        if self.open_until is None:
+            return 'closed'
+        if time.time() < self.open_until or self.probing:
+            return 'open'
+        return 'half-open'
+
+    def available(self):
+        return self.state() != 'open'
+
+    # let a call through, returning True if it is the half-open circuit's probe
+    def admit(self):
+        with self.lock:
+            state = self.state()
+            if state == 'open':
+                self.rejected += 1
+                metrics.count('vision_rejected')
+                raise VisionUnavailable('circuit open after repeated failures')
+            self.probing = state == 'half-open'
+            return self.probing
+
+    def trip(self, reason):
+        self.open_until = time.time() + self.cooldown
+        self.probing = False
+        print '! VisionClient | ERROR, ' + reason + ', pausing for ' + str(self.cooldown) + 's'
+
+    def record_latency(self, latency):
+        metrics.observe('vision', latency)
+        with self.lock:
+            self.calls += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def record_success(self, latency, probe=False):
+        self.record_latency(latency)
+        with self.lock:
+            if probe:
+                if self.verbose: print '- VisionClient | probe succeeded, closing the circuit'
+                self.open_until = None
+                self.probing = False
+            if self.open_until is None:
+                self.consecutive_failures = 0
+
+    # only failures while the circuit is closed count towards opening it. calls that were
+    # already in flight when it opened can't reopen it; only the probe decides that.
+    def record_failure(self, latency, error, probe=False):
+        self.record_latency(latency)
+        metrics.count('vision_failure')
+        with self.lock:
+            self.errors += 1
+            if probe:
+                self.trip('probe failed (' + error + ')')
+            elif self.open_until is None:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= self.failure_threshold:
+                    self.trip(str(self.consecutive_failures) + ' failures in a row (' + error + ')')
+
+    def analyze(self, body, content_type):
+        probe = self.admit()
+        try:
+            return self.call(body, content_type, probe)
+        finally:
+            # a probe that ended some other way mustn't leave the circuit waiting on it forever
+            with self.lock:
+                if probe and self.probing:
+                    self.trip('probe did not finish')
+
+    def call(self, body, content_type, probe):
+        headers = {
+            'Content-Type': content_type,
+            'Ocp-Apim-Subscription-Key': self.subscription_key,
+        }
+        params = {
+            'visualFeatures': 'Tags,Faces',
+            'language': 'en',
+        }
+
+        deadline = time.time() + self.deadline
+        for attempt in range(self.retries + 1):
+            start = time.time()
+            try:
+                r = self.session.post(self.uri, params=params, headers=headers, data=body,
+                    timeout=(3.05, max(min(self.timeout, deadline - start), 0.1)))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            else:
+                if r.status_code == 429 or r.status_code >= 500:
+                    error = 'HTTP ' + str(r.status_code)
+                elif r.status_code >= 400:
+                    # the API is healthy, it just doesn't like this image
+                    self.record_success(time.time() - start, probe)
+                    raise VisionError('HTTP ' + str(r.status_code) + ': ' + r.text)
+                else:
+                    self.record_success(time.time() - start, probe)
+                    return r.json()
+
+            self.record_failure(time.time() - start, error, probe)
+
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if probe or attempt == self.retries or time.time() + delay > deadline or self.state() != 'closed':
+                break
+            if self.verbose:
+                print '- VisionClient | ' + error + ', retrying in ' + str(round(delay, 2)) + 's'
+            metrics.count('vision_retry')
+            with self.lock:
+                self.retried += 1
+            time.sleep(delay)
+
+        raise VisionUnavailable(error)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'retried': self.retried,
+                'rejected': self.rejected,
+                'latency_mean': self.latency_total/self.calls if self.calls > 0 else 0.0,
+                'latency_max': self.latency_max,
+                'circuit': self.state()}
+
+# Replies and DMs aren't sent inline. They are queued in the 'outbox' collection and sent
+# from there, oldest first, so a slow or rate-limited Twitter API never holds up generating
+# questions and nothing is lost if a send fails. Sends are paced to stay inside each
+# endpoint's posting limit (counted from the outbox itself, so it survives restarts), failures
+# are retried with backoff, and a 429 pauses the endpoint until its window resets. The new
+# tweet/DM id is only recorded on the conversation once the send has succeeded.
+#
+# A message is claimed as 'sending', with a lease, before it is posted, and Twitter's
+# response_id is written to it before anything else. If the sender dies partway through, the
+# next one to find the lease run out finishes the send from the response_id. Without one it
+# can't know whether the post went out, and the message is failed rather than posted twice.
+class SendQueue():
+    # posting limits per endpoint, as (sends, window in seconds)
+    limits = {
+        'update_status': (300, 3*60*60),
+        'send_direct_message': (1000, 24*60*60)}
+
+    def __init__(self, db, twitter, min_spacing=1.0, max_attempts=5, backoff=30, lease=5*60, conversations=None, verbose=True):
+        self.db = db
+        self.twitter = twitter
+        self.conversations = conversations
+        self.min_spacing = min_spacing
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.verbose = verbose
+
+        self.db.outbox.create_index([('status', pymongo.ASCENDING), ('next_attempt', pymongo.ASCENDING)])
+        self.db.outbox.create_index([('endpoint', pymongo.ASCENDING), ('sent_at', pymongo.ASCENDING)])
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.paused_until = {}
+        self.last_sent = {}
+        self.thread = None
+        self.running = False
+
+    # target is the tweet being replied to for update_status, or the recipient for
+    # send_direct_message. incoming_id is the message we are answering.
+    def enqueue(self, endpoint, text, target, incoming_id, conversation_id=None):
+        now = datetime.datetime.utcnow()
+        try:
+            self.db.outbox.insert_one({
+                '_id': self.reply_id(incoming_id),
+                'endpoint': endpoint,
+                'text': text,
+                'target': target,
+                'incoming_id': incoming_id,
+                'conversation_id': conversation_id,
+                'status': 'pending',
+                'attempts': 0,
+                'created': now,
+                'next_attempt': now})
+        except pymongo.errors.DuplicateKeyError:
+            # this message has already been answered
+            return
+        self.wakeup.set()
+
+    # every incoming message gets at most one reply
+    def reply_id(self, incoming_id):
+        return 'reply:' + str(incoming_id)
+
+    def replied(self, incoming_id):
+        return self.db.outbox.find_one({'_id': self.reply_id(incoming_id)}, {'_id': 1}) is not None
+
+    def budget_left(self, endpoint):
+        sends, window = self.limits[endpoint]
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=window)
+        return sends - self.db.outbox.count({'endpoint': endpoint, 'sent_at': {'$gt': since}})
+
+    # send everything that is due and within its endpoint's budget. returns how many were sent.
+    def send_pending(self):
+        with self.lock:
+            self.recover()
+            sent = 0
+            due = self.db.outbox.find({'status': 'pending', 'next_attempt': {'$lte': datetime.datetime.utcnow()}})
+            for message in list(due.sort('created', pymongo.ASCENDING)):
+                endpoint = message['endpoint']
+                if time.time() < self.paused_until.get(endpoint, 0) or self.budget_left(endpoint) <= 0:
+                    continue
+
+                spacing = self.min_spacing - (time.time() - self.last_sent.get(endpoint, 0))
+                if spacing > 0:
+                    time.sleep(spacing)
+
+                if self.send(message):
+                    sent += 1
+            return sent
+
+    # take a pending message for sending. None if another sender already has it.
+    def claim(self, message):
+        lease_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease)
+        return self.db.outbox.find_one_and_update({'_id': message['_id'], 'status': 'pending'},
+            {'$set': {'status': 'sending', 'lease_until': lease_until}},
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def send(self, message):
+        message = self.claim(message)
+        if message is None:
+            return False
+
+        try:
+            with metrics.timer('send'):
+                if message['endpoint'] == 'update_status':
+                    response = self.twitter.update_status(message['text'], message['target'])
+                else:
+                    response = self.twitter.send_direct_message(message['target'], text=message['text'])
+        except tweepy.TweepError as e:
+            self.send_failed(message, e)
+            return False
+
+        # before anything else, so that a crash from here on never means posting it again
+        self.db.outbox.update_one({'_id': message['_id']}, {'$set': {
+            'sent_at': datetime.datetime.utcnow(),
+            'response_id': response.id}})
+        metrics.count('sent')
+
+        self.last_sent[message['endpoint']] = time.time()
+        print '* SendQueue | sent ' + message['endpoint'] + ':\n\t' + message['text']
+
+        self.finish(message, response.id)
+        return True
+
+    # record the reply on its conversation. this can run twice for the same message if a
+    # sender dies halfway through it, hence $addToSet.
+    def finish(self, message, response_id):
+        if message['conversation_id'] is not None:
+            self.db.conversations.update_one({'_id': message['conversation_id']}, {
+                '$addToSet': {'involved_tweets': {'$each': [message['incoming_id'], response_id]}},
+                '$set': {'last_tweet_id': response_id}})
+            if self.conversations is not None and message['endpoint'] == 'update_status':
+                self.conversations.sent(message['conversation_id'], 'tweet:' + str(response_id), response_id)
+        self.db.outbox.update_one({'_id': message['_id']}, {'$set': {'status': 'sent'}, '$unset': {'lease_until': ''}})
+
+    # pick up sends whose sender died before finishing them
+    def recover(self):
+        stale = self.db.outbox.find({'status': 'sending', 'lease_until': {'$lte': datetime.datetime.utcnow()}})
+        for message in list(stale):
+            if message.get('response_id') is not None:
+                if self.verbose: print '- SendQueue | finishing interrupted ' + message['endpoint'] + ' for ' + str(message['incoming_id'])
+                self.finish(message, message['response_id'])
+            else:
+                metrics.count('send_failure')
+                print '! SendQueue | ERROR, ' + message['endpoint'] + ' for ' + str(message['incoming_id']) + ' was interrupted and may have gone out, not retrying it'
+                self.db.outbox.update_one({'_id': message['_id'], 'status': 'sending'}, {'$set': {'status': 'failed'}})
+
+    def send_failed(self, message, error):
+        attempts = message['attempts'] + 1
+        print '! SendQueue | ERROR sending ' + message['endpoint'] + ' (attempt ' + str(attempts) + '): ' + str(error)
+
+        response = getattr(error, 'response', None)
+        metrics.count('send_failure')
+        if response is not None and response.status_code == 429:
+            metrics.count('send_rate_limited')
+            # out of budget as far as twitter is concerned, wait for the window to reset
+            reset = int(response.headers.get('x-rate-limit-reset', time.time() + 15*60))
+            self.paused_until[message['endpoint']] = reset
+            update = {'status': 'pending', 'next_attempt': datetime.datetime.utcfromtimestamp(reset)}
+        elif attempts >= self.max_attempts:
+            update = {'status': 'failed', 'attempts': attempts}
+        else:
+            delay = self.backoff * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+            update = {'status': 'pending', 'attempts': attempts,
+                'next_attempt': datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)}
+
+        self.db.outbox.update_one({'_id': message['_id']}, {'$set': update, '$unset': {'lease_until': ''}})
+
+    # keep sending from a background thread until stop() is called
+    def start(self):
+        def run():
+            while self.running:
+                try:
+                    self.send_pending()
+                except Exception as e:
+                    print '! SendQueue | ERROR while sending: ' + str(e)
+                self.wakeup.wait(5)
+                self.wakeup.clear()
+
+        self.running = True
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+# jobs are split into a fixed number of shards by conversation key, with a hash that is the
+# same in every process and on every host (unlike hash())
+NUM_SHARDS = 64
+
+def shard_of(key):
+    return (zlib.crc32(key) & 0xffffffff) % NUM_SHARDS
+
+# Durable work queue in the 'jobs' collection. Each incoming message moves through the
+# analyze and generate stages as a job (sending is SendQueue's job), and each stage is worked
+# by its own pool of threads. A job's _id comes from its stage and the tweet/DM id, so queueing
+# the same message twice is a no-op. Leasing a job pushes its available_at out by the
+# visibility timeout, so if a worker dies halfway the job becomes available again once that
+# passes. Jobs carry their conversation key and message id (seq) so that generation can wait
+# for earlier messages in the same conversation.
+class JobQueue():
+    def __init__(self, db, visibility_timeout=300, max_attempts=5, backoff=30, keep_done=7*24*60*60, verbose=True):
+        self.db = db
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.verbose = verbose
+
+        self.db.jobs.create_index([('stage', pymongo.ASCENDING), ('status', pymongo.ASCENDING), ('available_at', pymongo.ASCENDING)])
+        self.db.jobs.create_index([('key', pymongo.ASCENDING), ('seq', pymongo.ASCENDING)])
+        self.db.jobs.create_index('finished', expireAfterSeconds=keep_done)
+
+    def put(self, stage, job_id, key, seq, payload):
+        now = datetime.datetime.utcnow()
+        try:
+            self.db.jobs.insert_one({
+                '_id': stage + ':' + job_id,
+                'stage': stage,
+                'key': key,
+                'shard': shard_of(key),
+                'seq': seq,
+                'payload': payload,
+                'status': 'ready',
+                'attempts': 0,
+                'created': now,
+                'available_at': now})
+        except pymongo.errors.DuplicateKeyError:
+            # already queued, e.g. the same page was ingested again after a crash
+            pass
+
+    # shards limits the lease to jobs from those shards
+    def lease(self, stage, shards=None):
+        now = datetime.datetime.utcnow()
+        query = {'stage': stage, 'status': {'$in': ['ready', 'leased']}, 'available_at': {'$lte': now}}
+        if shards is not None:
+            query['shard'] = {'$in': shards}
+        return self.db.jobs.find_one_and_update(
+            query,
+            {'$set': {'status': 'leased', 'available_at': now + datetime.timedelta(seconds=self.visibility_timeout)},
+                '$inc': {'attempts': 1}},
+            sort=[('seq', pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    # the earliest job for an earlier message in the same conversation that hasn't finished,
+    # or None if the job is free to run
+    def blocker(self, job):
+        blockers = self.db.jobs.find({
+            'key': job['key'],
+            'seq': {'$lt': job['seq']},
+            'status': {'$in': ['ready', 'leased']}}, {'status': 1, 'available_at': 1})
+        for blocker in blockers.sort('seq', pymongo.ASCENDING).limit(1):
+            return blocker
+        return None
+
+    def complete(self, job):
+        self.db.jobs.update_one({'_id': job['_id']}, {'$set': {'status': 'done', 'finished': datetime.datetime.utcnow()}})
+
+    # put a job back for later without counting it as an attempt
+    def release(self, job, delay):
+        self.db.jobs.update_one({'_id': job['_id']}, {
+            '$set': {'status': 'ready', 'available_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)},
+            '$inc': {'attempts': -1}})
+
+    def retry(self, job, error):
+        print '! JobQueue | ERROR in ' + job['_id'] + ' (attempt ' + str(job['attempts']) + '): ' + str(error)
+        metrics.count('job_retry')
+        if job['attempts'] >= self.max_attempts:
+            metrics.count('job_failed')
+            self.db.jobs.update_one({'_id': job['_id']}, {'$set': {'status': 'failed', 'error': str(error)}})
+        else:
+            delay = self.backoff * 2 ** (job['attempts'] - 1) * random.uniform(0.5, 1.5)
+            self.db.jobs.update_one({'_id': job['_id']}, {'$set': {
+                'status': 'ready',
+                'error': str(error),
+                'available_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)}})
+
+    # jobs waiting or running in a stage, or only those that can be leased within the next few seconds
+    def depth(self, stage, within=None):
+        query = {'stage': stage, 'status': {'$in': ['ready', 'leased']}}
+        if within is not None:
+            query['status'] = 'ready'
+            query['available_at'] = {'$lte': datetime.datetime.utcnow() + datetime.timedelta(seconds=within)}
+        return self.db.jobs.count(query)
+
+# Splits the job shards between the worker processes on every host. Each process heartbeats
+# into the 'workers' collection and holds leases on its fair share of shards in 'shards',
+# renewing them as it goes. Shards whose owner stops renewing are picked up by the others, and
+# a process holding more than its share hands the extra back. All jobs for a conversation are
+# in one shard, so each conversation is worked by one process at a time.
+class ShardLeases():
+    # on_change is called with the new list of shards whenever it changes
+    def __init__(self, db, owner, ttl=30, on_change=None, verbose=True):
+        self.db = db
+        self.owner = owner
+        self.on_change = on_change
+        self.ttl = ttl
+        self.verbose = verbose
+        self.owned = []
+        self.stopping = threading.Event()
+        self.thread = None
+
+        # heartbeats are deleted once they expire
+        self.db.workers.create_index('expires', expireAfterSeconds=0)
+
+    def renew(self):
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=self.ttl)
+        self.db.workers.update_one({'_id': self.owner}, {'$set': {'expires': expires}}, upsert=True)
+        live = self.db.workers.count({'expires': {'$gt': now}})
+        share = -(-NUM_SHARDS // max(live, 1))
+
+        held = [s['_id'] for s in self.db.shards.find({'owner': self.owner, 'expires': {'$gt': now}}, {'_id': 1})]
+        owned, extra = held[:share], held[share:]
+        if len(extra) > 0:
+            self.db.shards.update_many({'_id': {'$in': extra}, 'owner': self.owner}, {'$set': {'expires': now}})
+        self.db.shards.update_many({'_id': {'$in': owned}, 'owner': self.owner}, {'$set': {'expires': expires}})
+
+        free = [shard for shard in range(NUM_SHARDS) if shard not in owned]
+        random.shuffle(free)
+        for shard in free:
+            if len(owned) >= share:
+                break
+            try:
+                # matches only an expired lease; if someone else holds it the upsert collides
+                self.db.shards.update_one({'_id': shard, 'expires': {'$lte': now}},
+                    {'$set': {'owner': self.owner, 'expires': expires}}, upsert=True)
+                owned.append(shard)
+            except pymongo.errors.DuplicateKeyError:
+                pass
+
+        if self.verbose and len(owned) != len(self.owned):
+            print '- ShardLeases | ' + self.owner + ' holds ' + str(len(owned)) + ' of ' + str(NUM_SHARDS) + \
+                ' shards, ' + str(live) + ' worker processes'
+        owned = sorted(owned)
+        if owned != self.owned and self.on_change is not None:
+            self.on_change(owned)
+        self.owned = owned
+
+    def start(self):
+        def run():
+            while not self.stopping.is_set():
+                try:
+                    self.renew()
+                except Exception as e:
+                    print '! ShardLeases | ERROR renewing leases: ' + str(e)
+                self.stopping.wait(self.ttl / 3.0)
+
+        self.stopping.clear()
+        self.renew()
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # stop renewing and hand our shards straight back to the other processes
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        self.owned = []
+        self.db.shards.update_many({'owner': self.owner}, {'$set': {'expires': datetime.datetime.utcnow()}})
+        self.db.workers.delete_one({'_id': self.owner})
+
+# the VADER lexicon is parsed from disk every time an analyzer is constructed, so the whole
+# process shares a single one, created the first time a reply needs scoring
+_sentiment_analyzer = None
+_sentiment_lock = threading.Lock()
+
+def sentiment_analyzer():
+    global _sentiment_analyzer
+    with _sentiment_lock:
+        if _sentiment_analyzer is None:
+            from nltk.sentiment.vader import SentimentIntensityAnalyzer
+            _sentiment_analyzer = SentimentIntensityAnalyzer()
+    return _sentiment_analyzer
+
+# Computer Vision results are cached in the 'image_cache' collection so that the same photo
+# (retweets, resent DMs, retried runs) only costs one API call. Public images are keyed by
+# their media URL, DM images by a hash of the downloaded bytes since every DM gets a new URL.
+class ImageCache():
+    def __init__(self, db, ttl=30*24*60*60, max_entries=10000, verbose=True):
+        self.db = db
+        self.max_entries = max_entries
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+
+        # mongo expires entries on its own once they are older than ttl seconds
+        self.db.image_cache.create_index('key', unique=True)
+        self.db.image_cache.create_index('created', expireAfterSeconds=ttl)
+
+        # create the counters up front, concurrent upserts could race on the unique type index
+        self.db.status.update_one({'type': 'image_cache'}, {'$setOnInsert': {'hits': 0, 'misses': 0}}, upsert=True)
+
+    def get(self, key):
+        entry = self.db.image_cache.find_one({'key': key}, {'analysis': 1})
+        if entry is None:
+            metrics.count('image_cache_miss')
+            self.misses += 1
+            self.db.status.update_one({'type': 'image_cache'}, {'$inc': {'misses': 1}})
+            if self.verbose:
+                print '- ImageCache | miss for ' + key
+            return None
+
+        metrics.count('image_cache_hit')
+        self.hits += 1
+        self.db.status.update_one({'type': 'image_cache'}, {'$inc': {'hits': 1}})
+        if self.verbose:
+            print '- ImageCache | hit for ' + key
+        return entry['analysis']
+
+    def put(self, key, analysis):
+        try:
+            self.db.image_cache.update_one({'key': key},
+                {'$set': {'analysis': analysis, 'created': datetime.datetime.utcnow()}}, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # another thread cached the same image at the same moment
+            return
+
+        # evict the oldest entries once the cache grows past its size limit
+        overflow = self.db.image_cache.count() - self.max_entries
+        if overflow > 0:
+            oldest = self.db.image_cache.find({}, {'_id': 1}).sort('created', pymongo.ASCENDING).limit(overflow)
+            self.db.image_cache.delete_many({'_id': {'$in': [e['_id'] for e in oldest]}})
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits)/lookups if lookups > 0 else 0.0}
+
+# Tags the vision API reports are considered in tiers: a medium priority tag is only chosen
+# when there is no high priority one, and so on. Each topic expands its own grammar symbol.
+TOPIC_TIERS = [
+    ['dog', 'cat', 'people', 'person', 'food'],
+    ['mountain', 'road', 'city', 'street', 'animal', 'book'],
+    ['outdoor', 'indoor', 'box', 'holding', 'document', 'text', 'envelope']]
+
+TOPIC_EXPANSIONS = {
+    'dog': '#dog#',
+    'cat': '#cat#',
+    'animal': '#animal#',
+    'child': '#child#',
+    'person': '#single_person#',
+    'people': '#people_group#',
+    'plant': '#plant#',
+    'outdoor': '#outdoor#',
+    'mountain': '#mountain#',
+    'road': '#city#',
+    'city': '#city#',
+    'street': '#city#',
+    'indoor': '#origin#',
+    'food': '#food#',
+    'box': '#box#',
+    'holding': '#holding#',
+    'book': '#book#',
+    'document': '#officey#',
+    'envelope': '#officey#',
+    'text': '#officey#',
+    'default': '#origin#'
+}
+
+# every expansion point get_question can start from
+EXPANSION_POINTS = set(TOPIC_EXPANSIONS.values()) | set(['#origin#', '#followup_selfie#', '#LinkFeelings#'])
+
+# tag -> (tier, position in the tier), for every tag that can become a topic
+TOPIC_INDEX = dict((tag, (tier, position)) for tier, tags in enumerate(TOPIC_TIERS) for position, tag in enumerate(tags))
+
+TAG_CONFIDENCE = 0.6
+PROMINENT_FACE = 0.1
+CHILD_AGE = 10
+
+# Turn vision API payloads into what topic selection needs: how many faces there are, how many
+# of them are prominent (more than a tenth of the photo) or children, how big each face is,
+# and the candidate topics from the best tier present. Every face and tag in the batch goes
+# into one flat array, thresholds are applied to the whole array at once and the results are
+# summed back per payload, so a batch costs about the same as a single photo. Setting up the
+# arrays costs more than a single photo's few faces and tags do in plain Python, though, so
+# one payload on its own goes through photo_features instead.
+def image_features(payloads):
+    if len(payloads) == 1:
+        return [photo_features(payloads[0])]
+
+    import numpy as np
+
+    face_owner = np.array([i for i, p in enumerate(payloads) for f in p['faces']], dtype=int)
+    face_areas = np.array([float(f['faceRectangle']['height'] * f['faceRectangle']['width']) for p in payloads for f in p['faces']])
+    face_ages = np.array([f['age'] for p in payloads for f in p['faces']], dtype=float)
+    image_areas = np.array([float(p['metadata']['height'] * p['metadata']['width']) for p in payloads])
+
+    face_sizes = face_areas / image_areas[face_owner] if len(face_owner) > 0 else np.zeros(0)
+    num_faces = np.bincount(face_owner, minlength=len(payloads))
+    num_prominent = np.bincount(face_owner, weights=(face_sizes > PROMINENT_FACE).astype(float), minlength=len(payloads))
+    num_children = np.bincount(face_owner, weights=(face_ages < CHILD_AGE).astype(float), minlength=len(payloads))
+
+    tag_owner = np.array([i for i, p in enumerate(payloads) for t in p['tags']], dtype=int)
+    tag_names = [t['name'] for p in payloads for t in p['tags']]
+    confident = np.array([t['confidence'] for p in payloads for t in p['tags']]) > TAG_CONFIDENCE
+    tiers = np.array([TOPIC_INDEX.get(name, (len(TOPIC_TIERS), 0))[0] for name in tag_names], dtype=int)
+    tiers[~confident] = len(TOPIC_TIERS)
+
+    # the best tier present for each payload
+    best = np.full(len(payloads), len(TOPIC_TIERS), dtype=int)
+    np.minimum.at(best, tag_owner, tiers)
+
+    face_offsets = np.concatenate([[0], np.cumsum(num_faces)])
+    tag_offsets = np.concatenate([[0], np.cumsum(np.bincount(tag_owner, minlength=len(payloads)))])
+    features = []
+    for i in range(len(payloads)):
+        start, end = tag_offsets[i], tag_offsets[i + 1]
+        # the API can report a tag more than once, but each topic should only be a candidate once
+        topics = sorted(set(tag_names[j] for j in np.flatnonzero(tiers[start:end] == best[i]) + start),
+            key=lambda name: TOPIC_INDEX[name][1]) if best[i] < len(TOPIC_TIERS) else []
+        # people are important! if someone is in the photo but it wasn't tagged, tag it with people now
+        if num_prominent[i] > 0:
+            topics = (topics if best[i] == 0 else []) + ['people']
+
+        features.append({
+            'num_faces': int(num_faces[i]),
+            'num_prominent_faces': int(num_prominent[i]),
+            'num_children': int(num_children[i]),
+            'face_sizes': face_sizes[face_offsets[i]:face_offsets[i + 1]].tolist(),
+            'topics': topics})
+    return features
+
+# image_features for a single payload, giving exactly the same answer
+def photo_features(payload):
+    image_area = float(payload['metadata']['height'] * payload['metadata']['width'])
+    face_sizes = [f['faceRectangle']['height'] * f['faceRectangle']['width'] / image_area for f in payload['faces']]
+    num_prominent = len([size for size in face_sizes if size > PROMINENT_FACE])
+
+    candidates = [(TOPIC_INDEX[t['name']], t['name']) for t in payload['tags']
+        if t['name'] in TOPIC_INDEX and t['confidence'] > TAG_CONFIDENCE]
+    best = min(candidates)[0][0] if len(candidates) > 0 else len(TOPIC_TIERS)
+    topics = [name for (tier, _), name in sorted(set(candidates)) if tier == best]
+    if num_prominent > 0:
+        topics = (topics if best == 0 else []) + ['people']
+
+    return {
+        'num_faces': len(face_sizes),
+        'num_prominent_faces': num_prominent,
+        'num_children': len([f for f in payload['faces'] if f['age'] < CHILD_AGE]),
+        'face_sizes': face_sizes,
+        'topics': topics}
+
+# One-time rules are numbered once and for all in the 'rule_bits' collection, so that the rules
+# a conversation has used can be stored as a bitmask that stays valid when the grammar
+# changes. A new rule gets the next free bit and a removed rule leaves its bit unused.
+class RuleBits():
+    def __init__(self, db, rules):
+        self.db = db
+        self.bits = dict((entry['_id'], entry['bit']) for entry in self.db.rule_bits.find())
+
+        # create the counter up front, concurrent upserts could race on the unique type index
+        self.db.status.update_one({'type': 'rule_bits'}, {'$setOnInsert': {'next': 0}}, upsert=True)
+        for rule in sorted(set(rules) - set(self.bits)):
+            counter = self.db.status.find_one_and_update({'type': 'rule_bits'}, {'$inc': {'next': 1}},
+                return_document=pymongo.ReturnDocument.AFTER)
+            try:
+                self.db.rule_bits.insert_one({'_id': rule, 'bit': counter['next'] - 1})
+                self.bits[rule] = counter['next'] - 1
+            except pymongo.errors.DuplicateKeyError:
+                # another process numbered it first
+                self.bits[rule] = self.db.rule_bits.find_one({'_id': rule})['bit']
+
+        self.rules = sorted(self.bits.items(), key=lambda item: item[1])
+
+    # rules that were never numbered (e.g. removed before numbering started) can't be used again anyway
+    def mask(self, rules):
+        mask = 0
+        for rule in rules:
+            if rule in self.bits:
+                mask |= 1 << self.bits[rule]
+        return mask
+
+    def names(self, mask):
+        return set(rule for rule, bit in self.rules if mask >> bit & 1)
+
+# A conversation, as kept in the 'conversations' collection. It carries only what generating
+# the next question needs: the face counts and candidate topics worked out from the photo, and
+# the one-time rules used so far, as a RuleBits mask (stored in hex). The raw vision response
+# is kept in the 'image_details' collection under the conversation's _id and read only if
+# something asks for it. The question history is only ever appended to, so it isn't loaded
+# either; history holds just the questions added since loading.
+class Conversation(object):
+    fields = ['image', 'user', 'num_messages', 'last_rule', 'is_selfie', 'asked', 'last_tweet_id',
+        'topic', 'topics', 'num_faces', 'num_children', 'num_prominent_faces', 'last_active']
+    __slots__ = fields + ['_id', 'sender_id', 'eliminated', 'history', 'stored', 'details', 'details_changed',
+        'load_details', 'legacy']
+
+    def __init__(self, image, sender_id=None):
+        self._id = bson.ObjectId()
+        self.image = image
+        self.sender_id = sender_id
+        self.user = ''
+        self.num_messages = 0
+        self.eliminated = 0
+        self.last_rule = None
+        self.is_selfie = False
+        self.asked = None
+        self.last_tweet_id = ''
+        self.topic = None
+        self.topics = None
+        self.num_faces = None
+        self.num_children = None
+        self.num_prominent_faces = None
+        self.last_active = None
+        self.history = []
+        self.stored = False
+        self.details = None
+        self.details_changed = False
+        self.load_details = None
+        self.legacy = []
+
+    @classmethod
+    def from_document(cls, document, rule_bits, load_details=None):
+        conversation = cls(document['image'], document.get('sender_id'))
+        conversation._id = document['_id']
+        conversation.stored = True
+        conversation.load_details = load_details
+        for field in cls.fields:
+            if field in document:
+                setattr(conversation, field, document[field])
+        if 'eliminated' in document:
+            conversation.eliminated = int(document['eliminated'], 16)
+
+        # conversations saved before this layout kept the used rules as a list and the vision
+        # response inline. they are moved over the next time the conversation is saved.
+        if 'eliminated_expansions' in document:
+            conversation.eliminated = rule_bits.mask(document['eliminated_expansions'])
+            if len(document['eliminated_expansions']) > 0:
+                conversation.last_rule = document['eliminated_expansions'][-1]
+            conversation.legacy.append('eliminated_expansions')
+        if 'image_details' in document:
+            conversation.image_details = document['image_details']
+            conversation.legacy.append('image_details')
+        return conversation
+
+    @property
+    def image_details(self):
+        if self.details is None and self.load_details is not None:
+            self.details = self.load_details(self._id)
+        return self.details
+
+    @image_details.setter
+    def image_details(self, details):
+        self.details = details
+        self.details_changed = True
+
+    def copy(self):
+        conversation = Conversation.__new__(Conversation)
+        for slot in self.__slots__:
+            setattr(conversation, slot, getattr(self, slot))
+        conversation.history = list(self.history)
+        conversation.legacy = list(self.legacy)
+        if self.topics is not None:
+            conversation.topics = list(self.topics)
+        return conversation
+
+    def document(self):
+        document = dict((field, getattr(self, field)) for field in self.fields)
+        document['_id'] = self._id
+        document['eliminated'] = format(self.eliminated, 'x')
+        document['history'] = list(self.history)
+        if self.topics is not None:
+            document['topics'] = list(self.topics)
+        if self.sender_id is not None:
+            document['sender_id'] = self.sender_id
+        return document
+
+# In-process LRU of active conversations, keyed the same way jobs are: 'dm:<sender id>', or
+# 'tweet:<id of our last reply>'. Saves write through to it. A tweet conversation is held
+# under its _id until SendQueue has sent the reply and knows the id it will be answered on.
+# Entries are dropped once a conversation is finished (5 messages), after ttl seconds
+# without use, when a new DM photo retires the sender's conversation, and when this process
+# hands the key's shard to another process. Lookups get a copy, so a message that fails
+# halfway never leaves its changes in the cache.
+class ConversationCache():
+    def __init__(self, max_entries=1000, ttl=60*60, verbose=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    self.keys.pop(entry[0]._id, None)
+                self.misses += 1
+                metrics.count('conversation_cache_miss')
+                return None
+
+            self.entries[key] = (entry[0], time.time() + self.ttl)
+            self.hits += 1
+            metrics.count('conversation_cache_hit')
+            return entry[0].copy()
+
+    # key is None while the conversation can't be looked up yet
+    def put(self, key, conversation):
+        with self.lock:
+            old_key = self.keys.pop(conversation._id, None)
+            if old_key is not None:
+                self.entries.pop(old_key, None)
+            if conversation.num_messages >= 5:
+                return
+
+            entry_key = key if key is not None else conversation._id
+            self.entries[entry_key] = (conversation.copy(), time.time() + self.ttl)
+            self.keys[conversation._id] = entry_key
+            while len(self.entries) > self.max_entries:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.keys.pop(evicted._id, None)
+
+    # the reply for a tweet conversation went out as last_tweet_id, which is what the user
+    # will answer
+    def sent(self, conversation_id, key, last_tweet_id):
+        with self.lock:
+            old_key = self.keys.pop(conversation_id, None)
+            entry = self.entries.pop(old_key, None) if old_key is not None else None
+            if entry is None:
+                return
+            entry[0].last_tweet_id = last_tweet_id
+            self.entries[key] = entry
+            self.keys[conversation_id] = key
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.keys.pop(entry[0]._id, None)
+
+    # drop every keyed entry keep() says no to
+    def retain(self, keep):
+        with self.lock:
+            for key in [k for k in self.entries if isinstance(k, basestring) and not keep(k)]:
+                self.keys.pop(self.entries.pop(key)[0]._id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits)/lookups if lookups > 0 else 0.0}
+
+# Finished conversations (five messages, a DM conversation retired by a newer photo, or one
+# nobody has answered in idle_after seconds, going by the last_active time each save sets) are
+# moved out of 'conversations' into 'archived_conversations', so the collection every message
+# is looked up in only holds conversations that can still go somewhere. Archiving waits until
+# a conversation is min_age old, which leaves time for its last reply to be sent and recorded.
+# An archived conversation keeps the fields it is looked up by; everything else is BSON
+# compressed with zlib. The raw vision response is dropped, since only the features taken
+# from it were ever used again. With ttl set, mongo deletes archived conversations that many
+# seconds after they were archived. The three partial indexes on 'conversations' each hold one
+# way of being closed, by age or by last activity, so compaction reads just what it moves
+# instead of scanning every active conversation.
+class ConversationArchive():
+    def __init__(self, db, min_age=24*60*60, idle_after=7*24*60*60, ttl=None, batch_size=500, verbose=True):
+        self.db = db
+        self.min_age = min_age
+        self.idle_after = idle_after
+        self.batch_size = batch_size
+        self.verbose = verbose
+
+        self.db.archived_conversations.create_index('last_tweet_id')
+        self.db.archived_conversations.create_index('sender_id')
+        if ttl is not None:
+            self.db.archived_conversations.create_index('archived', expireAfterSeconds=ttl)
+        try:
+            self.db.conversations.create_index([('_id', pymongo.ASCENDING), ('num_messages', pymongo.ASCENDING)],
+                name='finished_by_age', partialFilterExpression={'num_messages': {'$gte': 5}})
+            self.db.conversations.create_index([('_id', pymongo.ASCENDING), ('sender_id', pymongo.ASCENDING)],
+                name='retired_by_age', partialFilterExpression={'sender_id': {'$lt': 0}})
+            self.db.conversations.create_index([('last_active', pymongo.ASCENDING), ('num_messages', pymongo.ASCENDING)],
+                name='abandoned_by_activity', partialFilterExpression={'num_messages': {'$lt': 5}})
+        except pymongo.errors.OperationFailure as e:
+            print '! ConversationArchive | ERROR, could not create closed conversation indexes: ' + str(e)
+
+    @staticmethod
+    def pack(document, now):
+        entry = {'_id': document['_id'], 'archived': now}
+        for field in ['last_tweet_id', 'sender_id']:
+            if field in document:
+                entry[field] = document[field]
+        rest = dict((key, value) for key, value in document.items() if key not in entry and key != 'image_details')
+        entry['data'] = bson.Binary(zlib.compress(bson.BSON.encode(rest)))
+        return entry
+
+    @staticmethod
+    def unpack(entry):
+        document = bson.BSON(zlib.decompress(entry['data'])).decode()
+        for key, value in entry.items():
+            if key != 'data':
+                document[key] = value
+        return document
+
+    # move closed conversations over in batches, copying each batch before deleting it, so
+    # that an interrupted run loses nothing and the next one skips what was already copied.
+    # open conversations nobody has answered for idle_after seconds count as closed too.
+    # returns how many were archived.
+    def compact(self):
+        now = datetime.datetime.utcnow()
+        cutoff = bson.ObjectId.from_datetime(now - datetime.timedelta(seconds=self.min_age))
+        idle_cutoff = now - datetime.timedelta(seconds=self.idle_after)
+        # each branch carries its own bound and matches one partial index's filter, so each is
+        # answered from that index
+        query = {'$or': [
+            {'_id': {'$lt': cutoff}, 'num_messages': {'$gte': 5}},
+            {'_id': {'$lt': cutoff}, 'sender_id': {'$lt': 0}},
+            {'last_active': {'$lt': idle_cutoff}, 'num_messages': {'$lt': 5}}]}
+
+        archived = 0
+        while True:
+            documents = list(self.db.conversations.find(query).limit(self.batch_size))
+            if len(documents) == 0:
+                break
+
+            now = datetime.datetime.utcnow()
+            ids = [document['_id'] for document in documents]
+            try:
+                self.db.archived_conversations.insert_many([ConversationArchive.pack(d, now) for d in documents], ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+            self.db.conversations.delete_many({'_id': {'$in': ids}})
+            self.db.image_details.delete_many({'_id': {'$in': ids}})
+
+            archived += len(documents)
+            metrics.count('conversations_archived', len(documents))
+            if self.verbose:
+                print '- ConversationArchive | archived ' + str(archived) + ' conversations'
+
+        return archived
+
+    def find(self, query):
+        entry = self.db.archived_conversations.find_one(query)
+        return ConversationArchive.unpack(entry) if entry is not None else None
+
+# Questions expanded ahead of time, so that answering a message doesn't wait on the grammar.
+# There is a pool for each expansion point and set of eliminated one-time rules that matter
+# to it (the ones it can reach), filled by the same constrained expansion get_question would
+# otherwise run, so a question taken from a pool is distributed exactly like one expanded on
+# the spot. Pools are created the first time they are asked for and topped up to size by a
+# background thread. Past max_pools the least recently used is dropped. Taking a question
+# pops it, and when a pool is empty the question is expanded inline as before. What is left to
+# ask for a key (options) is worked out once and kept, so a take never walks the grammar.
+class QuestionPool():
+    def __init__(self, expand, scope, options, size=8, max_pools=256, verbose=True):
+        self.expand = expand
+        self.scope = scope
+        self.options = options
+        self.size = size
+        self.max_pools = max_pools
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pools = collections.OrderedDict()
+        self.taken_once = collections.OrderedDict()
+        self.remaining_options = collections.OrderedDict()
+        self.exhausted = set()
+        self.scopes = {}
+        self.hits = 0
+        self.misses = 0
+        self.thread = None
+        self.running = False
+
+    # the pool key: the expansion point and the eliminated rules it can reach
+    def key(self, rule, eliminated):
+        if rule not in self.scopes:
+            self.scopes[rule] = self.scope(rule)
+        return (rule, eliminated & self.scopes[rule])
+
+    # the one-time rules still left to ask for a key, or None if it is exhausted
+    def remaining(self, rule, eliminated):
+        key = self.key(rule, eliminated)
+        with self.lock:
+            if key in self.exhausted:
+                return None
+            remaining = self.remaining_options.pop(key, None)
+        if remaining is None:
+            remaining = self.options(key[0], key[1])
+
+        with self.lock:
+            if remaining is None:
+                self.exhausted.add(key)
+                return None
+            self.remaining_options[key] = remaining
+            while len(self.remaining_options) > self.max_pools:
+                self.remaining_options.popitem(last=False)
+        return remaining
+
+    def warm(self, rules):
+        with self.lock:
+            for rule in rules:
+                self.pools.setdefault(self.key(rule, 0), collections.deque())
+        self.wakeup.set()
+
+    # returns (question, one-time rules used), or None if every question is used up. a key
+    # only gets a pool once it is warmed or taken a second time; most conversations move on to
+    # a new eliminated mask after every question, so filling a pool on the first take is wasted.
+    def take(self, rule, eliminated):
+        key = self.key(rule, eliminated)
+        with self.lock:
+            if key in self.exhausted:
+                return None
+            pool = self.pools.pop(key, None)
+            if pool is None and self.taken_once.pop(key, None) is None:
+                self.taken_once[key] = True
+                while len(self.taken_once) > self.max_pools:
+                    self.taken_once.popitem(last=False)
+            else:
+                if pool is None:
+                    pool = collections.deque()
+                self.pools[key] = pool
+                while len(self.pools) > self.max_pools:
+                    self.pools.popitem(last=False)
+            question = pool.popleft() if pool else None
+
+        if pool is not None and len(pool) < self.size / 2:
+            self.wakeup.set()
+        if question is not None:
+            self.hits += 1
+            metrics.count('question_pool_hit')
+            return question
+
+        self.misses += 1
+        metrics.count('question_pool_miss')
+        return self.expand(key[0], key[1])
+
+    # top up every pool, most recently used first
+    def refill(self):
+        with self.lock:
+            keys = list(reversed(self.pools))
+        for key in keys:
+            while self.running:
+                with self.lock:
+                    pool = self.pools.get(key)
+                    if pool is None or len(pool) >= self.size:
+                        break
+                question = self.expand(key[0], key[1])
+                with self.lock:
+                    if question is None:
+                        self.exhausted.add(key)
+                        self.pools.pop(key, None)
+                        break
+                    pool.append(question)
+
+    def start(self):
+        def run():
+            while self.running:
+                try:
+                    self.refill()
+                except Exception as e:
+                    print '! QuestionPool | ERROR while refilling: ' + str(e)
+                self.wakeup.wait(5)
+                self.wakeup.clear()
+
+        self.running = True
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        takes = self.hits + self.misses
+        with self.lock:
+            pooled = sum(len(pool) for pool in self.pools.values())
+        return {
+            'pools': len(self.pools),
+            'pooled': pooled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits)/takes if takes > 0 else 0.0}
+
 class QuestionGenerator():
-    def __init__(self, api_keys, cookies, verbose=True):
+    def __init__(self, api_keys, cookies, verbose=True, threads=4, analyze_workers=None, generate_workers=None,
+            concurrency=None, archive_after=24*60*60, archive_idle_after=7*24*60*60, archive_ttl=None):
         self.api_keys = api_keys
         self.verbose = verbose
+        self.threads = threads
+        self.archive_after = archive_after
+        self.archive_idle_after = archive_idle_after
+        self.archive_ttl = archive_ttl
+        self.workers = {
+            'analyze': analyze_workers or threads,
+            'generate': generate_workers or threads}
 
-        # QUESTION GENERATION GRAMMAR
-        # capitalized replacement values are one-time use per conversation
-        self.generator = {
-            # categories for specific types of images
-            "single_person": ["#Isselfie#", "#Isselfie#", "#single_person_other#"], "single_person_other": ["#Feelings#", "#Technology#", "#Social#"],
-            "people_group": ["#Where#", "#Whygroup#", "#Meet#", "#Know#"],
-            "cat": ["#Awwname#", "I've always fancied myself a cat-chatbot. #Howlongpet#", "#Catsound#", "#Catstory#"],
-            "dog": ["#Awwname#", "#Dog#", "#Dogappreciate#", "#Dogsound#"],
-            "animal": ["#Awwname#", "#Whatkindanimal#", "#Whatanimaldoing#", "#Why#"],
-            "plant": ["#Garden#", "#Why#", "#Context#", "#Grow#"],
-            "outdoor": ["#Where#", "#Garden#", "#Technology#"],
-            "mountain": ["#Where#", "#Vista#", "#Alone#", "#Untaken#"],
-            "city": ["#Neighborhood#", "#Where#", "#Rediscover#", "#Untaken#"],
-            "food": ["#Food#", "#Eatenwith#", "#Whofor#", "#Couldi#", "#Feelmeal#", "#Social#"],
-            "indoor": ["#Comfortable#", "#Where#", "#Whofor#", "#Rediscover#"],
-            "holding": ["#Holding#", "#Why#"],
-            "book": ["#Book#", "#Why#", "#Whofor#"],
-            "child": ["#Child#", "#Rediscover#", "#Untaken#"],
-            "box": ["#Box#", "#Why#"],
-            "officey": ["#Remember#", "#Feelings#", "#Why#"],
-            
-            # conversation
-            "followup_selfie": ["#Social#", "#Whofor#", "#Context#", "#Feelings#"],
-            "followup_generic": ["#Tellmemore#", "#Rediscover#", "#Feelings#"],
-            "followup_outdoor": ["#Weather#"],
-            "followup_city": ["#Return# #Dodifferent#"],
-            "followup_food": ["#origin#", "#food#", "#LinkFood#"],
-            
-            # wildcard category
-            "origin": ["#Why#",
-                "#Whofor#",
-                "#Where#",
-                "#Rediscover#",
-                "#Feelings#",
-                "#Isms#",
-                "#Context#",
-                "#Encouraging#",
-                "#Surprised#",
-                "#Social#",
-                "#Untaken#",
-                "#Composition#",
-                "#Alone#",
-                "#Technology#",
-                "#Remember#",
-                "#Return#"],
-            
-            # individual question concepts (not to be repeated)
-            # animals
-            "Dog": ["I love dogs. #Howlongpet#"],
-            "Cat": ["Oh, a cat! I love cats, but sometimes they can be real jerks. What's yours like?"],
-            "Catsound": ["Meow! Does your cat like people?"],
-            "Dogsound": ["Woof! Do you have more than one dog?"],
-            "Dogappreciate": ["Oh, a dog! I don't like dogs much myself... what do you appreciate about this one?"],
-            "Catstory": ["How did you first meet this cat?", "What's your favorite story with this cat?", "What's the story of this cat?"],
-            "Whatanimaldoing": ["What did you seem them doing that #inspire.ed# you to take a #picture#?"],
-            "Whatkindanimal": ["What kind of animal is that?"],
-            "Awwname": ["Aww, what's their name?"],
-            "Howlongpet": ["How long have you had them?"],
-
-            # plants
-            "Garden": ["In some sense, it's like a garden. What do you like about it?", "Is that a garden?", "Is that your garden?", "What a nice place to sit and think. Do you agree?"],
-            "Grow": ["Did you grow that?", "How long have you known that plant?", "How long has that been growing?", "When did you first notice that plant?"],
-
-            # food
-            "Food": ["Did you make that?",  "How did that taste?", "How would you make that differently next time?"],
-            "Feelmeal": ["#howwhat.capitalize# did you feel #beforeafter# #this# meal?", "#howwhat.capitalize# did you feel #beforeafter# you ate #this#?"],
-            "Eatenwith": ["Who did you eat that with?", "Who do you wish you could have eaten that with?"],
-            "LinkFood": ["Do you have another food photo to share?"],
-            "Couldi": ["That looks good, do you think I could make that?", "That recipe looks complicated, I bet I couldn't make it. Or maybe I could?", "That looks hard to cook, I wonder if I could make it. Did you?"],
-
-            # children
-            "Child": ["Is that your #kid#?", "What does that #kid# want to be when they grow up?"],
-
-            # selfie
-            "Isselfie": ["Is #this# you?", "Is #this# a #picture# of you?", "Is #this# a selfie?"],
-            
-            # generic followup
-            "Tellmemore": ["Can you tell me more about that?", "What do you mean?", "Why do you think that is?", "Is that really true?", "Really?"],
-            
-            # place
-            "Weather": ["Was the weather what you expected?"],
-            "Where": ["Where was #this# #taken#?", "Where did you #take# #this# #picture#?", "Do you #visit# this #place# #often#?", "Have you visited this #place# before?"],
-            "Vista": ["That #scenery# is #encouraging_words#. Did you go #recreation#?"],
-            "Neighborhood": ["Did you enjoy your time in this neighborhood?", "What would you compare this neighborhood to?"],
-            "Return": ["Do you plan to return here?", "Will you visit this place again?"],
-            "Dodifferent": ["What will you do differently?", "What would you do differently?", "What else would you do?"],
-            "Comfortable": ["Is this a place you like to be?", "Is this a place you feel comfortable?", "Is this a place you feel at home?"],
-
-            # composition
-            "Isms": ["Were you thinking about #isms# when you #took# #this# #picture#?"],
-            "Composition": ["Why didn't you zoom in?", "Why didn't you zoom out?", "What was behind you?"],
-            "Technology": ["How would #this# #picture# have been different if you took it with #device#?"],
-
-            # why
-            "Encouraging": ["#encouraging_words.capitalize#! What #inspire.ed# you to #take# #this#?"],
-            "Surprised": ["#interjections.capitalize#! I'm not sure what to say... do you #like# #this# #picture#?"],
-            "Why": ["Why did you #take# #this# #picture#?"],
-
-            # context
-            "Untaken": ["#encouraging_words.capitalize#... but what didn't you take a picture of that day?", "#encouraging_words.capitalize#... but what didn't you take a picture of there?"],
-            "Context": ["Where did you go after you #took# #this# #picture#?", "What did you do #beforeafter# you #took# #this# #picture#?", "What were you doing when you #took# #this# #picture#?"],
-            "Social": ["I bet you didn't put #this# on #facebook#. Why not?", "I bet you put #this# on #facebook#. Who did you want to see it?", "Did you think about uploading this to #facebook#?"],
-
-            # people
-            "Alone": ["Were you alone when you #took# #this# #picture#? Why?", "Who were you with when you #took# #this# #picture#?", "Who did you spend this day with?"],
-            "Whygroup": ["#Why#", "Why did you #take# #this# #picture# here?", "Why did you choose this spot?"],
-            "Whofor": ["Who did you #take# this #picture# for?", "#whowhat.capitalize# were you thinking about when you #took# #this# #picture#?"],
-            "Meet": ["How did you meet #these# people?", "Who did you most recently meet?", "Who have you known the longest?"],
-            "Know": ["How do you know #these# people?", "Do you consider yourself close to #this# group?", "What do you normally do with #these# people?"],
-
-            # feelings
-            "Feelings": ["#howwhat.capitalize# did you feel #beforeafter# you #took# #this# #picture#?"],
-            "LinkFeelings": ["Did taking the #picture# change how you feel?", "Do you frequently feel like #this# when you take photos?"],
-
-            # memories
-            "Remember": ["What did you want to remember from #this# scene?", "What do you want to remember most from #this# #picture#?"],
-            "Rediscover": ["If you were to #find# this #picture# in #duration#, what #wouldwouldnt# you want to #remember# about it?"],
-            "Important": ["In #duration#, do you think this #picture# will be more or less important to you than it is now?", "Is this #picture# important to you? Why?"],
-
-            # objects
-            "Holding": ["What do they have?", "What are they holding?", "What is that?"],
-            "Book": ["What's your favorite book?", "Can you recommend a book?", "Have you read anything good lately?"],
-            "Box": ["What's in the box?", "Ooh, what's inside the box?", "Open up the box! Tell me what's inside!"],
-
-            # thesauruses to make question generation more interesting
-            "device": ["a film camera", "an SLR", "your old smartphone", "your grandfather's camera"],
-            "find": ["rediscover", "find", "run across", "turn up"],
-            "visit": ["visit", "pass through", "walk around", "#take# #picture.s# in", "explore"], 
-            "place": ["place", "location", "area", "site", "neighborhood", "street"],
-            "often": ["often", "frequently", "occasionally", "sometimes", "all the time", "every day"],
-            "facebook": ["Facebook", "Snapchat", "Instagram", "Twitter"],
-            "beforeafter": ["before", "after", "just before", "just after"],
-            "whowhat": ["who", "what"],
-            "howwhat": ["how", "what"],
-            "take": ["take", "capture", "photograph", "shoot", "record"],
-            "taken": ["taken", "captured", "photographed", "shot", "recorded"],
-            "took": ["took", "captured", "photographed", "shot", "recorded"],
-            "picture": ["picture", "photo", "image", "snapshot", "pic", "photograph", "shot"],
-            "this": ["this", "that"],
-            "these": ["these", "those"],
-            "yearmonth": ["year", "month"],
-            "duration": ["#singular#", "#plural#"],
-            "singular": ["one #yearmonth#"],
-            "yearmonth": ["year", "month"],
-            "plural": ["#num# #yearsmonths#"],
-            "num": ["two", "three", "four", "five"],
-            "yearsmonths": ["years", "months"],
-            "remember": ["remember", "tell yourself", "tell #person#", "explain", "forget", "analyze", "figure out", "feel", "believe", "remember"],
-            "wouldwouldnt": ["would", "wouldn't"],
-            "person": ["yourself", "your children", "your partner", "your coworker", "your father", "your mother", "your brother", "your sister", "your ex"],
-            "inspire": ["inspire", "motivate", "prompt", "influence", "provoke", "spark"],
-            "like": ["like", "love", "dislike", "enjoy", "feel strongly about", "admire", "regret"],
-            "scenery": ["scenery", "view", "vista"],
-            "recreation": ["hiking", "for a walk", "exploring", "climbing", "camping", "roadtripping"],
-            "kid": ["kid", "child", "little one"],
-
-            "isms": ["abstract expressionism","action painting","aestheticism","art deco","art nouveau","avant-garde","baroque","bauhaus","classicism","cloisonnism","color field painting","conceptual art","cubism","cubo-futurism","dada","dadaism","deformalism","divisionism","eclecticism","ego-futurism","existentialism","expressionism","fauvism","fluxus","formalism","futurism","geometric abstraction","gothic art","historicism","humanism","hyperrealism","idealism","illusionism","impressionism","installation art","intervention art","jugendstil","kinetic art","land art","luminism","lyrical abstraction","mail art","manierism","mannerism","maximalism","merovingian","metaphysical art ","minimalism","modern art","modernism","monumentalism","multiculturalism","naturalism","neo-classicism","neo-dada","neo-expressionism","neo-fauvism","neo-geo","neo-impressionism","neo-minimalism","neoclassicism","neoism","new media art","new objectivity","nonconformism","nouveau realisme","op art","orphism","outsider art","performance art","perspectivism","photorealism","pointilism","pop art","post-conceptualism","post-impressionism","post-minimalism","post-structuralism","postminimalism","postmodernism","precisionism","primitivism","purism","rayonism","realism","relational art","remodernism","renaissance","rococo","romanesque","romanticism","russian futurism","russian symbolism","secularism","situationalism","social realism","socialist realism","sound art","street art","structuralism","suprematism","surrealism","symbolism","synchromism","synthetism","tachism","tachisme","tonalism","video art","video game art","vorticism"],
-            "encouraging_words": ["amazing","awesome","beautiful","bravo","brilliant","breathtaking","congratulations","cool","dazzling","delightful","electrifying","elegant","enchanting","excellent","exciting","fabulous","fantastic","fun","genius","groundbreaking","heavenly","impressive","innovative","inventive","kind","legendary","lifechanging","lovely","magical","marvelous","masterful","miraculous","original","perfect","phenomenal","powerful","remarkable","rejuvenating","resounding","skillful","stupendous","stunning","sweet","terrific","thoughtful","thrilling","wonderful","wondrous"],
-            "interjections": ["aah","ack","agreed","ah","aha","ahem","alas","all right","amen","argh","as if","aw","ay","aye","bah","blast","boo hoo","bother","boy","brr","by golly","bye","cheerio","cheers","chin up","come on","crikey","curses","dear me","doggone","drat","duh","easy does it","eek","egads","er","exactly","fair enough","fiddle-dee-dee","fiddlesticks","fie","foo","fooey","gadzooks","gah","gangway","g'day","gee","gee whiz","geez","gesundheit","get lost","get outta here","go on","good","good golly","good job","gosh","gracious","great","grr","gulp","ha","ha-ha","hah","hallelujah","harrumph","haw","hee","here","hey","hmm","ho hum","hoo","hooray","hot dog","how","huh","hum","humbug","hurray","huzza","I say","ick","is it","ixnay","jeez","just kidding","just a sec","just wondering","kapish","la","la-di-dah","lo","look","look here","long time","lordy","man","meh","mmm","most certainly","my","my my","my word","nah","naw","never","no","no can do","nooo","not","no thanks","no way","nuts","oh","oho","oh-oh","oh no","okay","okey-dokey","om","oof","ooh","oopsey","over","oy","oyez","peace","pff","pew","phew","pish posh","psst","ptui","quite","rah","rats","ready","right","right on","roger","roger that","rumble","say","see ya","shame","shh","shoo","shucks","sigh","sleep tight","snap","sorry","sssh","sup","ta","ta-da","ta ta","take that","tally ho","tch","thanks","there","there there","time out","toodles","touche","tsk","tsk-tsk","tut","tut-tut","ugh","uh","uh-oh","um","ur","urgh","very nice","very well","voila","vroom","wah","well","well done","well, well","what","whatever","whee","when","whoa","whoo","whoopee","whoops","whoopsey","whew","why","word","wow","wuzzup","ya","yea","yeah","yech","yikes","yippee","yo","yoo-hoo","you bet","you don't say","you know","yow","yum","yummy","zap","zounds","zowie","zzz"
-          ]
-        }
+        # one limit on how many twitter fetches and jobs run at once, across ingest and every
+        # stage. by default it is as many as there are threads to run them.
+        self.slots = threading.BoundedSemaphore(concurrency or self.workers['analyze'] + self.workers['generate'] + 2)
 
-        # PROMPT GENERATOR GRAMMAR
-        # this grammar is used to generate requests for more photos
-        self.prompt_generator = {
-            "origin": [
-                "#show_me# #picture.a# that makes you feel #feeling#.", "#can_i_see# #picture.a# that makes you feel #feeling#?",
-                "#show_me# #picture.a# from #duration# ago.", "#can_i_see# #picture.a# from #duration# ago?",
-                "#show_me# your favorite recent #picture#.", "#can_i_see# your favorite recent #picture#?",
-                "#show_me# the last #picture#  you put on #facebook#.", "#can_i_see# the last #picture# you put on #facebook#?",
-                "#show_me# the #picture_adjective# #picture# you took in the last #duration#.", "#can_i_see# the #picture_adjective# #picture# you took in the last #duration#?",
-                "#show_me# #encouraging_words.a# #picture#.", "#can_i_see# #encouraging_words.a# #picture#?",
-                "#show_me# #picture.a# that makes you say \"#interjections#!\"", "#can_i_see# #picture.a# that makes you say \"#interjections#?\"",
-                "#show_me# #picture.a# you haven't seen in a while.", "#can_i_see# #picture.a# you haven't looked at in a while?",
-                "#show_me# #picture.a# you #took# for #person#.", "#can_i_see# #picture.a# you #took# for #person#?",
-                "#show_me# #picture.a# from #place.a# you #visit# #often#.", "#can_i_see# #picture.a# from #place.a# you #visit# #often#?",
-                "#show_me# #picture.a# you #took# #alone#.", "#can_i_see# #picture.a# you #took# #alone#?",
-                "#show_me# #picture.a# of a recent meal.", "#can_i_see# #picture.a# of a recent meal?"
-            ],
-            
-            "picture_adjective": ["most interesting", "most exciting", "most playful", "most beautiful", "biggest", "smallest", "darkest", "brightest", "most colorful", "loudest", "quietest", "most experimental", "most surprising", "least expected", "least desired", "least interesting", "ugliest", "worst", "best"],
-            "feeling_noun": ["proud", "in awe", "accepting", "neglectful", "regretful"],
-            "feeling": ["happy", "nostalgic", "anxious", "energetic", "tired", "forgetful", "old", "young", "love", "regret", "fortunate", "realized", "successful", "proud", "uncomfortable", "fantastic", "surprised", "satisfied", "proud"],
-
-            "show_me": ["Show me", "Let me see", "Let me look at", "Find", "Let's talk about", "Let's take a look at", "I'd like to take a look at", "I'd like to see", "Search for", "Look for", "Browse for", "Send me"],
-            "can_i_see": ["Can I see", "Can you find", "Can you show me", "Could I see", "Could you let me take a look at", "Could we talk about", "Can we talk about", "Can you send me", "Could you send me"],
-
-            "alone": ["alone", "by yourself", "with friends", "with a friend", "with a group of friends", "with co-workers", "with classmates", "with family", "with a family member", "with a stranger", "with a new friend"],
-            "find": ["rediscover", "find", "run across", "turn up"],
-            "visit": ["visit", "pass through", "walk around", "#take# pictures in"], 
-            "place": ["place", "location", "area", "site", "neighborhood", "street"],
-            "often": ["often", "frequently", "occasionally", "sometimes", "all the time", "every day"],
-            "facebook": ["Facebook", "Snapchat", "Instagram", "Twitter"],
-            "beforeafter": ["before", "after", "just before", "just after"],
-            "whowhat": ["who", "what"],
-            "howwhat": ["how", "what"],
-            "take": ["take", "capture", "photograph", "shoot", "record"],
-            "taken": ["taken", "captured", "photographed", "shot", "recorded"],
-            "took": ["took", "captured", "photographed", "shot", "recorded", "took", "took"],
-            "picture": ["picture", "photo", "image", "snapshot", "pic", "photograph", "shot"],
-            "this": ["this", "that"],
-            "yearmonth": ["year", "month", "week"],
-            "duration": ["#singular#", "#plural#"],
-            "singular": ["one #yearmonth#"],
-            "plural": ["#num# #yearsmonths#"],
-            "num": ["two", "three", "four", "five"],
-            "yearsmonths": ["years", "months", "weeks"],
-            "remember": ["remember", "tell yourself", "tell #person#", "explain", "forget", "analyze", "figure out", "feel", "believe", "remember"],
-            "wouldwouldnt": ["would", "wouldn't"],
-            "person": ["yourself", "your children", "your partner", "your coworker", "your father", "your mother", "your brother", "your sister", "your ex"],
-            "inspire": ["inspire", "motivate", "prompt", "influence", "provoke", "spark", "sway"],
-            "like": ["like", "love", "dislike", "enjoy", "feel strongly about", "admire", "regret"],
-            
-            "encouraging_words": ["amazing","awesome","beautiful","bravo","brilliant","breathtaking","congratulations","cool","dazzling","delightful","electrifying","elegant","enchanting","excellent","exciting","fabulous","fantastic","fun","genius","groundbreaking","heavenly","impressive","innovative","inventive","kind","legendary","lifechanging","lovely","magical","marvelous","masterful","miraculous","original","perfect","phenomenal","powerful","remarkable","rejuvenating","resounding","skillful","stupendous","stunning","sweet","terrific","thoughtful","thrilling","wonderful","wondrous"],
-            "interjections": ["aah","ack","agreed","ah","aha","ahem","alas","all right","amen","argh","as if","aw","ay","aye","bah","blast","boo hoo","bother","boy","brr","by golly","bye","cheerio","cheers","chin up","come on","crikey","curses","dear me","doggone","drat","duh","easy does it","eek","egads","er","exactly","fair enough","fiddle-dee-dee","fiddlesticks","fie","foo","fooey","gadzooks","gah","gangway","g'day","gee","gee whiz","geez","gesundheit","get lost","get outta here","go on","good","good golly","good job","gosh","gracious","great","grr","gulp","ha","ha-ha","hah","hallelujah","harrumph","haw","hee","here","hey","hmm","ho hum","hoo","hooray","hot dog","how","huh","hum","humbug","hurray","huzza","I say","ick","is it","ixnay","jeez","just kidding","just a sec","just wondering","kapish","la","la-di-dah","lo","look","look here","long time","lordy","man","meh","mmm","most certainly","my","my my","my word","nah","naw","never","no","no can do","nooo","not","no thanks","no way","nuts","oh","oho","oh-oh","oh no","okay","okey-dokey","om","oof","ooh","oopsey","over","oy","oyez","peace","pff","pew","phew","pish posh","psst","ptui","quite","rah","rats","ready","right","right on","roger","roger that","rumble","say","see ya","shame","shh","shoo","shucks","sigh","sleep tight","snap","sorry","sssh","sup","ta","ta-da","ta ta","take that","tally ho","tch","thanks","there","there there","time out","toodles","touche","tsk","tsk-tsk","tut","tut-tut","ugh","uh","uh-oh","um","ur","urgh","very nice","very well","voila","vroom","wah","well","well done","well, well","what","whatever","whee","when","whoa","whoo","whoopee","whoops","whoopsey","whew","why","word","wow","wuzzup","ya","yea","yeah","yech","yikes","yippee","yo","yoo-hoo","you bet","you don't say","you know","yow","yum","yummy","zap","zounds","zowie","zzz"]
-        }
+        # the grammars and the image cache are set up on first use, see __getattr__
+        self.lazy_lock = threading.RLock()
+        self.pruned_grammars = collections.OrderedDict()
+        self.pruned_lock = threading.Lock()
 
         # CONVERSATION ENDING GRAMMAR (not Tracery, yet)
         #  this is used to "gracefuly" exit conversations
@@ -279,6 +1511,68 @@ class QuestionGenerator():
 
         client = pymongo.MongoClient('localhost', 27017)
         self.db = client.reflect
+        self.ensure_indexes()
+
+        auth = tweepy.OAuthHandler(self.api_keys['twitter']['consumer_token'], self.api_keys['twitter']['consumer_secret'])
+        auth.set_access_token(self.api_keys['twitter']['key'], self.api_keys['twitter']['secret'])
+        self.twitter = tweepy.API(auth)
+        self.cookies = cookies
+
+        # keep-alive HTTP sessions, reused across polls when running as a daemon, with a
+        # connection pool big enough for every processing thread
+        self.http = requests.Session()
+        self.http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=threads))
+        self.dm_http = requests.Session()
+        self.dm_http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=threads))
+        for cookie in self.cookies:
+            self.dm_http.cookies.set(cookie['name'], cookie['value'])
+
+        self.vision = VisionClient(self.api_keys['microsoft'], self.http, verbose=verbose)
+        self.conversations = ConversationCache(verbose=verbose)
+        self.outbox = SendQueue(self.db, self.twitter, conversations=self.conversations, verbose=verbose)
+        self.jobs = JobQueue(self.db, verbose=verbose)
+        self.shards = None
+
+        self.running = False
+        self.ingest_stats = {}
+        self.prefetched = {}
+
+    # attributes that are only set up the first time they are used, and what sets them up
+    lazy_attributes = dict(
+        [(name, 'load_grammars') for name in ['generator', 'generator_references', 'generator_reachable',
+            'generator_dependents', 'generator_one_time_rules', 'prompt_generator', 'grammar', 'prompt_grammar',
+            'rule_bits', 'questions']] +
+        [('image_cache', 'load_image_cache'), ('archive', 'load_archive')])
+
+    def __getattr__(self, name):
+        if name not in QuestionGenerator.lazy_attributes:
+            raise AttributeError(name)
+        with self.lazy_lock:
+            if name not in self.__dict__:
+                getattr(self, QuestionGenerator.lazy_attributes[name])()
+        return self.__dict__[name]
+
+    def load_grammars(self):
+        import tracery
+        import tracery.modifiers
+
+        if self.verbose:
+            print "- load_grammars | loading grammars"
+
+        # QUESTION GENERATION GRAMMAR
+        # capitalized replacement values are one-time use per conversation
+        questions = load_grammar(os.path.join(GRAMMAR_DIR, 'questions.json'))
+        self.generator = questions['rules']
+        self.generator_references = questions['references']
+        self.generator_reachable = questions['reachable']
+        self.generator_dependents = questions['dependents']
+        self.generator_one_time_rules = questions['one_time_rules']
+
+        # PROMPT GENERATOR GRAMMAR
+        # this grammar is used to generate requests for more photos
+        self.prompt_generator = load_grammar(os.path.join(GRAMMAR_DIR, 'prompts.json'))['rules']
+
+        self.rule_bits = RuleBits(self.db, questions['one_time_rules'])
 
         self.grammar = tracery.Grammar(self.generator)
         self.grammar.add_modifiers(tracery.modifiers.base_english)
@@ -286,208 +1580,370 @@ class QuestionGenerator():
         self.prompt_grammar = tracery.Grammar(self.prompt_generator)
         self.prompt_grammar.add_modifiers(tracery.modifiers.base_english)
 
-        auth = tweepy.OAuthHandler(self.api_keys['twitter']['consumer_token'], self.api_keys['twitter']['consumer_secret'])
-        auth.set_access_token(self.api_keys['twitter']['key'], self.api_keys['twitter']['secret'])
-        self.twitter = tweepy.API(auth)
-        self.cookies = cookies
+        self.questions = QuestionPool(self.expand_question, self.rule_scope, self.remaining_options, verbose=self.verbose)
+
+    def load_image_cache(self):
+        self.image_cache = ImageCache(self.db, verbose=self.verbose)
+
+    def load_archive(self):
+        self.archive = ConversationArchive(self.db, min_age=self.archive_after, idle_after=self.archive_idle_after,
+            ttl=self.archive_ttl, verbose=self.verbose)
        
+    # create the indexes that conversation lookups rely on. creating an index that already
+    # exists is a no-op, so this runs on every start. there is at most one conversation per
+    # bot tweet and one active (positive sender_id) DM conversation per sender.
+    def ensure_indexes(self):
+        self.db.status.create_index('type', unique=True)
+        try:
+            self.db.conversations.create_index('last_tweet_id', unique=True,
+                partialFilterExpression={'last_tweet_id': {'$gt': 0}})
+            self.db.conversations.create_index('sender_id', unique=True,
+                partialFilterExpression={'sender_id': {'$gt': 0}})
+        except pymongo.errors.OperationFailure as e:
+            print '! ensure_indexes | ERROR, could not create unique conversation indexes: ' + str(e)
+
     def analyze_image(self, im_url, dm=False):
-        subscription_key = self.api_keys['microsoft']
-        uri_base = 'https://westcentralus.api.cognitive.microsoft.com'
+        # if it's a DM we have to load up some cookies, download the image, and reupload it to microsoft
+        if dm:
+            body = self.download_dm_media(im_url)
+            content_type = 'application/octet-stream'
+            cache_key = 'sha1:' + hashlib.sha1(body).hexdigest()
+        
+        # otherwise, it's publicly accessible
+        else:
+            body = "{'url':'" + im_url + "'}"
+            content_type = 'application/json'
+            cache_key = im_url
 
-        headers = {
-            # Request headers.
-            'Content-Type': 'application/json',
-            'Ocp-Apim-Subscription-Key': subscription_key,
-        }
+        analysis = self.image_cache.get(cache_key)
+        if analysis is not None:
+            return analysis
 
-        params = urllib.urlencode({
-            # Request parameters. All of them are optional.
-            'visualFeatures': 'Tags,Faces',
-            'language': 'en',
-        })
-            
+        if dm:
+            body = self.downscale_image(body)
+        
+        analysis = self.vision.analyze(body, content_type)
+        print(analysis)
+
+        self.image_cache.put(cache_key, analysis)
+        return analysis
+
+    # download DM media with the cookie-authenticated session, streaming it in chunks so that
+    # an oversized or stalled download is abandoned instead of holding up the whole run
+    def download_dm_media(self, im_url):
+        response = self.dm_http.get(im_url, stream=True, timeout=MEDIA_TIMEOUT)
         try:
-            # if it's a DM we have to load up some cookies, download the image, and reupload it to microsoft
-            if dm:
-                session = requests.Session()
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                # an expired or forbidden link won't come back, so ask the user for another photo
+                raise VisionError('could not download DM media: HTTP ' + str(response.status_code))
+            response.raise_for_status()
+            if int(response.headers.get('Content-Length', 0)) > MAX_MEDIA_BYTES:
+                raise VisionError('DM media is larger than ' + str(MAX_MEDIA_BYTES) + ' bytes')
 
-                for cookie in cookies:
-                    session.cookies.set(cookie['name'], cookie['value'])
+            deadline = time.time() + MEDIA_DEADLINE
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > MAX_MEDIA_BYTES:
+                    raise VisionError('DM media is larger than ' + str(MAX_MEDIA_BYTES) + ' bytes')
+                if time.time() > deadline:
+                    raise IOError('DM media took longer than ' + str(MEDIA_DEADLINE) + 's to download')
+                chunks.append(chunk)
+        finally:
+            response.close()
 
-                response = session.get(im_url, stream=True)
-                response.raw.decode_content = True
-                headers['Content-Type'] = 'application/octet-stream'
-                body = response.raw
-            
-            # otherwise, it's publicly accessible
-            else:
-                body = "{'url':'" + im_url + "'}"
-            
-            r = requests.post(uri_base + "/vision/v1.0/analyze?%s" % params, headers=headers, data=body)
-            analysis = r.json()
-            print(analysis)
-            return analysis
-        except Exception as e:
-            print('Error:')
-            print(e)
-            
-            return e
+        return ''.join(chunks)
+
+    # shrink a photo so its longest side is VISION_MAX_DIMENSION, re-encoding it as a JPEG.
+    # anything Pillow can't read is passed through untouched for the vision API to judge.
+    def downscale_image(self, data):
+        if Image is None:
+            return data
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            if max(image.size) <= VISION_MAX_DIMENSION:
+                return data
 
-    def get_question(self, conversation, last_response='', dm=False):
+            image.thumbnail((VISION_MAX_DIMENSION, VISION_MAX_DIMENSION), Image.ANTIALIAS)
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=90)
+        except IOError:
+            return data
+
+        if self.verbose:
+            print '- downscale_image | shrunk DM photo from ' + str(len(data)) + ' to ' + str(output.tell()) + ' bytes'
+        return output.getvalue()
+
+    # work out the face statistics and candidate topics get_question chooses from
+    def describe_image(self, conversation):
+        image_details = conversation.image_details
+        features = image_features([image_details])[0]
+        image_details['face_sizes'] = features['face_sizes']
+        conversation.image_details = image_details
+        conversation.num_faces = features['num_faces']
+        conversation.num_children = features['num_children']
+        conversation.num_prominent_faces = features['num_prominent_faces']
+        conversation.topics = features['topics']
+
+    # confirmed can carry a sentiment score for last_response worked out ahead of time
+    def get_question(self, conversation, last_response='', dm=False, confirmed=None):
         # is there a response earlier in the conversation, and did we ask a question?
         if (last_response != ''):
-            if conversation['asked'] == 'selfie':
-                isselfie = self.confirmed(last_response)
+            if conversation.asked == 'selfie':
+                isselfie = confirmed if confirmed is not None else self.confirmed(last_response)
                 if self.verbose:
                     print "- get_question | believe selfie is " + str(isselfie) + ' from "' + last_response + '"'
-                conversation['is_selfie'] = isselfie
+                conversation.is_selfie = isselfie
             
         response = ''
 
-        if 'image_details' not in conversation:
-            if self.verbose:
-                print "- get_question | analyzing image"
-            image_details = self.analyze_image(conversation['image'], dm=dm)
-            conversation['image_details'] = image_details
-        
-            num_faces = len(conversation['image_details']['faces'])
-            
-            if num_faces > 0:
-                face_sizes = [float(f['faceRectangle']['height'] * f['faceRectangle']['width'])/float(conversation['image_details']['metadata']['height'] * conversation['image_details']['metadata']['width']) for f in conversation['image_details']['faces']]
-                conversation['image_details']['face_sizes'] = face_sizes
-                num_prominent_faces = np.sum(conversation['image_details']['face_sizes'] > 0.1)
-                num_children = np.sum([face['age'] < 10 for face in conversation['image_details']['faces']])
-            else:
-                num_prominent_faces = 0
-                num_children = 0
-            
-            conversation['num_faces'] = num_faces
-            conversation['num_children'] = num_children
-            conversation['num_prominent_faces'] = num_prominent_faces
-        
-        tags = [t['name'] for t in conversation['image_details']['tags'] if t['confidence'] > 0.6]
+        if conversation.topics is None:
+            if conversation.image_details is None:
+                if self.verbose:
+                    print "- get_question | analyzing image"
+                conversation.image_details = self.analyze_image(conversation.image, dm=dm)
+            self.describe_image(conversation)
 
-        # different tags that MS reports in the image have different priority levels
-        # only if there is no high priority tag is a medium priority tag selected, etc
-        high_priority = ['dog', 'cat', 'people', 'person', 'food']
-        medium_priority = ['mountain', 'road', 'city', 'street', 'animal', 'book']
-        low_priority = ['outdoor', 'indoor', 'box', 'holding', 'document', 'text', 'envelope']
-        
-        high_present = [t for t in high_priority if t in tags]
-        medium_present = [t for t in medium_priority if t in tags]
-        low_present = [t for t in low_priority if t in tags]
-        
-        # people are important! if someone is in the photo but it wasn't already tagged, tag it with people now
-        if (conversation['num_prominent_faces'] > 0):
-            high_present.append('people')
-
-        if conversation['num_messages'] == 0:
-            if (conversation['num_children']) > 0:
-                high_present = ['child']
-            elif (conversation['num_prominent_faces'] == 1):
-                high_present = ['person']
-        
-        choosen = 'default'
-        if len(high_present) > 0:
-            choosen = random.choice(high_present)
-        elif len(medium_present) > 0:
-            choosen = random.choice(medium_present)
-        elif len(low_present) > 0:
-            choosen = random.choice(low_present)
-            
-        conversation['topic'] = choosen
-        
-        expansion = {
-            'dog': '#dog#',
-            'cat': '#cat#',
-            'animal': '#animal#',
-            'person': '#single_person#',
-            'people': '#people_group#',
-            'plant': '#plant#', 
-            'outdoor': '#outdoor#',
-            'mountain': '#mountain#',
-            'road': '#city#',
-            'city': '#city#',
-            'street': '#city#',
-            'indoor': '#origin#',
-            'food': '#food#',
-            'box': '#box#',
-            'holding': '#holding',
-            'book': '#book#',
-            'document': '#officey#',
-            'envelope': '#officey#',
-            'text': '#officey#',
-            'default': '#origin#'
-        }
-            
-        expansion_point = expansion[choosen]
+        topics = conversation.topics
+        if conversation.num_messages == 0:
+            if (conversation.num_children) > 0:
+                topics = ['child']
+            elif (conversation.num_prominent_faces == 1):
+                topics = ['person']
+
+        choosen = random.choice(topics) if len(topics) > 0 else 'default'
+        conversation.topic = choosen
+
+        expansion_point = TOPIC_EXPANSIONS[choosen]
             
         # continuing a conversation    
-        if conversation['is_selfie']:
+        if conversation.is_selfie:
             expansion_point = "#followup_selfie#"
-        try:
-            if conversation['eliminated_expansions'][-1] == "Feelings":
-                expansion_point = "#LinkFeelings#"
-        except:
-            pass
+        if conversation.last_rule == "Feelings":
+            expansion_point = "#LinkFeelings#"
 
         if self.verbose:
             print "- get_question | expansion_point: " + expansion_point
-        expansion = self.grammar.expand(expansion_point)
-        num_tries = 0
-        response = ''
-        
-        flattened_grammar = self.flatten_grammar(expansion)
-        
-        while(len(response) == 0):
-            questions_used = [c.raw for c in flattened_grammar if c.type == 1 and c.raw[0].isupper()]
-            print "- get_question | using question " + str(questions_used)
-            if any([q in conversation['eliminated_expansions'] for q in questions_used]):
+        with metrics.timer('grammar'):
+            # exhausted topics are known from the grammar's index, so nothing is expanded just to fail.
+            # the pool keeps the answer, which is the same for every conversation sharing its key.
+            remaining = self.questions.remaining(expansion_point, conversation.eliminated)
+            if remaining is None:
+                metrics.count('grammar_fallback')
                 if self.verbose:
-                    print "- get_question | already used question"
-                # now we need to try again
-                num_tries += 1
-                if num_tries > 5:
-                    expansion_point = '#origin#'
-                expansion = self.grammar.expand(expansion_point)
-                flattened_grammar = self.flatten_grammar(expansion)
-            else:
-                response = expansion.finished_text
-                conversation['eliminated_expansions'] += questions_used
+                    print "- get_question | " + expansion_point + " is exhausted, falling back to #origin#"
+                expansion_point = '#origin#'
+                remaining = self.questions.remaining(expansion_point, conversation.eliminated)
+            if self.verbose and remaining is not None:
+                print "- get_question | " + str(len(remaining)) + " questions left from " + expansion_point
+            question = self.questions.take(expansion_point, conversation.eliminated) if remaining is not None else None
+
+        if question is not None:
+            response, questions_used = question
+            print "- get_question | using question " + str(questions_used)
+            conversation.eliminated |= self.rule_bits.mask(questions_used)
+            if len(questions_used) > 0:
+                conversation.last_rule = questions_used[-1]
+        else:
+            # every question we know has been asked, so wrap the conversation up
+            metrics.count('grammar_exhausted')
+            print "! get_question | ERROR, every question has been used in this conversation"
+            questions_used = []
+            response = random.choice(self.conversation_excuses)
         
-        if 'Isselfie' in [c.raw for c in flattened_grammar if c.type == 1]:
-            conversation['asked'] = 'selfie'
+        if 'Isselfie' in questions_used:
+            conversation.asked = 'selfie'
             if self.verbose:
                 print "- get_question | asking if this is a selfie"
         else:
-            conversation['asked'] = None
+            conversation.asked = None
         
-        conversation['history'].append(response)
+        conversation.history.append(response)
         
-        conversation['num_messages'] += 1
+        conversation.num_messages += 1
         
         return (response, conversation)
 
-    # flatten the grammar tree into a list
-    def flatten_grammar(self, a):
-        if a.type != 0:
-            return [a] + reduce(lambda x,y: x+self.flatten_grammar(y), a.children,[])
-        else:
-            return [a]
-
-    def new_conversation(self, url):
-        conversation = {
-            'num_messages': 0,
-            'history': [],
-            'eliminated_expansions': [],
-            'user': '',
-            'image': url,
-            'is_selfie': False,
-            'asked': None,
-            'involved_tweets': [],
-            'last_tweet_id': ''}
-        return conversation
+    # the symbols that can't be expanded once the eliminated one-time rules are used up: those
+    # rules, and every symbol whose alternatives all refer to a dead symbol. only the symbols
+    # that refer to something newly dead need to be looked at again.
+    def dead_symbols(self, eliminated):
+        dead = set(eliminated) & set(self.generator)
+        pending = list(dead)
+        while len(pending) > 0:
+            for symbol in self.generator_dependents[pending.pop()]:
+                if symbol not in dead and all(r & dead for r in self.generator_references[symbol]):
+                    dead.add(symbol)
+                    pending.append(symbol)
+        return dead
+
+    # the one-time rules an expansion point can still ask, given a conversation's eliminated
+    # mask, or None if the expansion point is exhausted and can't be expanded at all
+    def remaining_options(self, rule, eliminated):
+        dead = self.dead_symbols(self.rule_bits.names(eliminated))
+        if rule_references(rule) & dead:
+            return None
+
+        live = set()
+        pending = list(rule_references(rule))
+        while len(pending) > 0:
+            symbol = pending.pop()
+            if symbol in live or symbol not in self.generator:
+                continue
+            live.add(symbol)
+            for references in self.generator_references[symbol]:
+                if not references & dead:
+                    pending.extend(references)
+        return live & self.generator_one_time_rules
+
+    # expand a rule without ever choosing an alternative that leads to an eliminated one-time
+    # rule. dead symbols are found first and pruned from the grammar, so the expansion always
+    # succeeds on the first try. returns None if the rule itself can only reach eliminated rules.
+    def expand_constrained(self, rule, eliminated):
+        if len(eliminated) == 0:
+            return self.grammar.expand(rule)
+
+        dead = self.dead_symbols(eliminated)
+        if rule_references(rule) & dead:
+            return None
+
+        return self.pruned_grammar(dead).expand(rule)
+
+    # the question grammar without the dead symbols and every alternative that uses one. the
+    # same few dead sets come up over and over, so the most recently used grammars are kept.
+    def pruned_grammar(self, dead):
+        dead = frozenset(dead)
+        with self.pruned_lock:
+            grammar = self.pruned_grammars.pop(dead, None)
+            if grammar is not None:
+                self.pruned_grammars[dead] = grammar
+                return grammar
+
+        pruned = {}
+        for symbol, alternatives in self.generator.items():
+            if symbol not in dead:
+                references = self.generator_references[symbol]
+                pruned[symbol] = [a for a, r in zip(alternatives, references) if not r & dead]
+
+        import tracery
+        import tracery.modifiers
+        grammar = tracery.Grammar(pruned)
+        grammar.add_modifiers(tracery.modifiers.base_english)
+        with self.pruned_lock:
+            self.pruned_grammars[dead] = grammar
+            while len(self.pruned_grammars) > 64:
+                self.pruned_grammars.popitem(last=False)
+        return grammar
+
+    # fill pools for every expansion point get_question starts from, then keep them full
+    def start_question_pool(self):
+        self.questions.warm(EXPANSION_POINTS)
+        self.questions.start()
+
+    # a finished question and the one-time rules it used, for QuestionPool
+    def expand_question(self, rule, eliminated):
+        expansion = self.expand_constrained(rule, self.rule_bits.names(eliminated))
+        if expansion is None:
+            return None
+        return (expansion.finished_text, list(self.one_time_rules(expansion)))
+
+    # the one-time rules an expansion point can reach, as a mask
+    def rule_scope(self, rule):
+        reachable = set()
+        for symbol in rule_references(rule):
+            reachable |= self.generator_reachable.get(symbol, set())
+        return self.rule_bits.mask(reachable)
+
+    # walk the expansion tree depth-first without recursion, yielding the capitalized
+    # (one-time use) rules it contains in the order they appear
+    def one_time_rules(self, root):
+        stack = [root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.type == 1 and node.raw[0].isupper():
+                yield node.raw
+            if node.type != 0:
+                stack.extend(reversed(node.children))
+
+    # load a conversation, leaving out its history and the tweets involved. key is the
+    # conversation's key for the cache.
+    def find_conversation(self, query, key):
+        conversation = self.conversations.get(key)
+        if conversation is not None:
+            return conversation
+
+        with metrics.timer('mongo_find'):
+            document = self.db.conversations.find_one(query, {'history': 0, 'involved_tweets': 0})
+        if document is None:
+            return None
+        return Conversation.from_document(document, self.rule_bits, self.load_image_details)
+
+    def load_image_details(self, conversation_id):
+        entry = self.db.image_details.find_one({'_id': conversation_id})
+        return entry['details'] if entry is not None else None
+
+    # copy a conversation's fields so save_conversation can tell what changed
+    def snapshot(self, conversation):
+        return conversation.document()
+
+    # write only what changed since the snapshot, matched by _id. items appended to a list are
+    # $push-ed, the message count is $inc-ed and any other changed field is $set. new
+    # conversations are only inserted here, once a reply has been generated, so a failed
+    # vision call doesn't leave a half-made conversation behind.
+    def save_conversation(self, conversation, before):
+        with metrics.timer('mongo_update'):
+            if conversation.details_changed:
+                self.db.image_details.update_one({'_id': conversation._id},
+                    {'$set': {'details': conversation.details}}, upsert=True)
+                conversation.details_changed = False
+
+            conversation.last_active = datetime.datetime.utcnow()
+            document = conversation.document()
+            if not conversation.stored:
+                document['involved_tweets'] = []
+                try:
+                    self.db.conversations.insert_one(document)
+                except pymongo.errors.DuplicateKeyError:
+                    metrics.count('duplicate_conversation')
+                    raise
+                conversation.stored = True
+                self.conversations.put(self.conversation_key(conversation), conversation)
+                return
+
+            update = {}
+            for key, value in document.items():
+                if key == '_id':
+                    continue
+
+                old = before.get(key)
+                if isinstance(value, list) and isinstance(old, list) and value[:len(old)] == old:
+                    if len(value) > len(old):
+                        update.setdefault('$push', {})[key] = {'$each': value[len(old):]}
+                elif key == 'num_messages' and key in before:
+                    if value != old:
+                        update.setdefault('$inc', {})[key] = value - old
+                elif key not in before or (value is not old and value != old):
+                    update.setdefault('$set', {})[key] = value
+
+            # the mask was worked out from the legacy list on load, so it has to be written out
+            # even when nothing was used this time (an excuse), before the list is dropped
+            if len(conversation.legacy) > 0:
+                update.setdefault('$set', {})['eliminated'] = document['eliminated']
+            for key in conversation.legacy:
+                update.setdefault('$unset', {})[key] = ''
+            conversation.legacy = []
+
+            if len(update) > 0:
+                self.db.conversations.update_one({'_id': conversation._id}, update)
+            self.conversations.put(self.conversation_key(conversation), conversation)
+
+    # the key a saved conversation will be looked up by next, if it is known yet
+    def conversation_key(self, conversation):
+        if conversation.sender_id is not None:
+            return 'dm:' + str(conversation.sender_id)
+        return None
 
     def cleanup_tweet(self, tw, dm=False):
         if dm:
@@ -497,188 +1953,624 @@ class QuestionGenerator():
         splat = [s for s in splat if s[:4] != 'http' and s[:1] != '@']
         return " ".join(splat)
 
-    def process_tweet(self, tw):
+    # image_details and confirmed are filled in when the analyze stage and ingestion have
+    # already done that work
+    # vision_error is set when the analyze stage has already found the photo can't be analyzed
+    def process_tweet(self, tw, image_details=None, confirmed=None, vision_error=None):
         if 'media' in tw.entities:
+            if vision_error is not None:
+                print '! process_tweet | ERROR, could not analyze image: ' + vision_error
+                output = self.prompt_grammar.flatten("#origin#")
+                self.outbox.enqueue('update_status', '@' + tw.user.screen_name + ' ' + output, tw.id, tw.id)
+                print '* process_tweet | queueing new tweet:\n\t' + output
+                return -1
+
             if self.verbose:
                 print '- process_tweet | tweet has image, creating new conversation'
-            conversation = self.new_conversation(tw.entities['media'][0]['media_url'])
-            self.db.conversations.insert_one(conversation)
+            conversation = Conversation(tw.entities['media'][0]['media_url'])
+            if image_details is not None:
+                conversation.image_details = image_details
         else:
             if tw.in_reply_to_status_id:
-                conversations = list(self.db.conversations.find({'last_tweet_id': tw.in_reply_to_status_id}))
-                if len(conversations) == 1:
+                conversation = self.find_conversation({'last_tweet_id': tw.in_reply_to_status_id}, self.tweet_key(tw))
+                if conversation is not None:
                     if self.verbose:
                         print '- process_tweet | found matching conversation for thread'
-                    conversation = conversations[0]
-                elif len(conversations) == 0:
-                    print '! process_tweet | ERROR, no matching conversation found'
-                    output = self.prompt_grammar.flatten("#origin#")
-                    response = self.twitter.update_status('@' + tw.user.screen_name + ' ' + output, tw.id)
-                    print '* process_tweet | tweeting new tweet:\n\t' + output
-                    return -1
+                elif self.archive.find({'last_tweet_id': tw.in_reply_to_status_id}) is not None:
+                    print '- process_tweet | too many tweets'
+                    return
                 else:
-                    print '! process_tweet | ERROR, multiple matching conversations found'
+                    print '! process_tweet | ERROR, no matching conversation found'
                     output = self.prompt_grammar.flatten("#origin#")
-                    response = self.twitter.update_status('@' + tw.user.screen_name + ' ' + output, tw.id)
-                    print '* process_tweet | tweeting new tweet:\n\t' + output
+                    self.outbox.enqueue('update_status', '@' + tw.user.screen_name + ' ' + output, tw.id, tw.id)
+                    print '* process_tweet | queueing new tweet:\n\t' + output
                     return -1
             else:
                 print '! process_tweet | ERROR, tweet has no media and is not reply'
                 output = self.prompt_grammar.flatten("#origin#")
-                response = self.twitter.update_status('@' + tw.user.screen_name + ' ' + output, tw.id)
-                print '* process_tweet | tweeting new tweet:\n\t' + output    
+                self.outbox.enqueue('update_status', '@' + tw.user.screen_name + ' ' + output, tw.id, tw.id)
+                print '* process_tweet | queueing new tweet:\n\t' + output    
+                return -1
+
+        before = self.snapshot(conversation)
+
+        if conversation.num_messages < 4:
+            try:
+                output = self.get_question(conversation, last_response=self.cleanup_tweet(tw), confirmed=confirmed)
+            except VisionError as e:
+                print '! process_tweet | ERROR, could not analyze image: ' + str(e)
+                output = self.prompt_grammar.flatten("#origin#")
+                self.outbox.enqueue('update_status', '@' + tw.user.screen_name + ' ' + output, tw.id, tw.id)
+                print '* process_tweet | queueing new tweet:\n\t' + output
                 return -1
-        
-        if conversation['num_messages'] < 4:
-            output = self.get_question(conversation, last_response=self.cleanup_tweet(tw))
             
             # tweet generated question
-            print '* process_tweet | tweeting new tweet:\n\t' + output[0]
+            print '* process_tweet | queueing new tweet:\n\t' + output[0]
             
-            response = self.twitter.update_status('@' + tw.user.screen_name + ' ' + output[0], tw.id)
             conversation = output[1]
-            conversation['involved_tweets'] += [tw.id, response.id]
-            conversation['last_tweet_id'] = response.id
-            
-            self.db.conversations.update_one({'image': conversation['image']}, {'$set': conversation})
-        elif conversation['num_messages'] < 5:
+            self.save_conversation(conversation, before)
+
+            # the tweet ids are recorded on the conversation once the reply has actually been sent
+            self.outbox.enqueue('update_status', '@' + tw.user.screen_name + ' ' + output[0], tw.id, tw.id, conversation._id)
+        elif conversation.num_messages < 5:
             output = random.choice(self.conversation_excuses)
 
             # tweet generated question
-            print '* process_tweet | tweeting new tweet:\n\t' + output
-            
-            response = self.twitter.update_status('@' + tw.user.screen_name + ' ' + output, tw.id)
-            conversation['num_messages'] += 1
-            conversation['involved_tweets'] += [tw.id, response.id]
-            conversation['last_tweet_id'] = response.id
+            print '* process_tweet | queueing new tweet:\n\t' + output
             
-            self.db.conversations.update_one({'image': conversation['image']}, {'$set': conversation})
+            conversation.num_messages += 1
+            self.save_conversation(conversation, before)
+
+            self.outbox.enqueue('update_status', '@' + tw.user.screen_name + ' ' + output, tw.id, tw.id, conversation._id)
         else:
             print '- process_tweet | too many tweets'
 
         return
 
     # processing DMs is a little bit different because there is no threading on the conversation
-    def process_dm(self, tw):
+    def process_dm(self, tw, image_details=None, confirmed=None, vision_error=None):
         if 'media' in tw.entities:
             if self.verbose:
                 print '- process_dm | tweet has image, creating new conversation'
-            conversation = self.new_conversation(tw.entities['media'][0]['media_url'])
-            conversation['sender_id'] = tw.sender_id
+            conversation = Conversation(tw.entities['media'][0]['media_url'], sender_id=tw.sender_id)
+            if image_details is not None:
+                conversation.image_details = image_details
 
             # disable old conversations with this user, but maintain them in the database for posterity
             self.db.conversations.update_many({'sender_id': tw.sender_id}, {'$set': {'sender_id': tw.sender_id*-1}})
-            self.db.conversations.insert_one(conversation)
+            self.conversations.discard(self.dm_key(tw))
+
+            if vision_error is not None:
+                print '! process_dm | ERROR, could not analyze image: ' + vision_error
+                output = self.prompt_grammar.flatten("#origin#")
+                self.outbox.enqueue('send_direct_message', output, tw.sender_id, tw.id)
+                print '* process_dm | queueing new tweet:\n\t' + output
+                return -1
         else:
-            conversations = list(self.db.conversations.find({'sender_id': tw.sender_id}))
-            if len(conversations) == 1:
+            conversation = self.find_conversation({'sender_id': tw.sender_id}, self.dm_key(tw))
+            if conversation is not None:
                 if self.verbose:
                     print '- process_dm | found matching conversation for thread'
-                conversation = conversations[0]
-            elif len(conversations) == 0:
+            elif self.archive.find({'sender_id': tw.sender_id}) is not None:
+                print '- process_dm | too many responses... waiting for new media message'
+                return
+            else:
                 print '! process_dm | ERROR, no matching conversation found'
                 # respond with a photo prompt
                 output = self.prompt_grammar.flatten("#origin#")
-                response = self.twitter.send_direct_message(tw.sender_id, text=output)
-                print '* process_dm | tweeting new tweet:\n\t' + output
+                self.outbox.enqueue('send_direct_message', output, tw.sender_id, tw.id)
+                print '* process_dm | queueing new tweet:\n\t' + output
                 return -1
-            else:
-                print '! process_dm | ERROR, multiple matching conversations found'
-                # respond with a photo prompt
+
+        before = self.snapshot(conversation)
+
+        if conversation.num_messages < 4:
+            # for DMs we also have to let the analyze_image method know that it needs to upload a copy of the photo to microsoft
+            try:
+                output = self.get_question(conversation, last_response=self.cleanup_tweet(tw, dm=True), dm=True, confirmed=confirmed)
+            except VisionError as e:
+                print '! process_dm | ERROR, could not analyze image: ' + str(e)
                 output = self.prompt_grammar.flatten("#origin#")
-                response = self.twitter.send_direct_message(tw.sender_id, text=output)
-                print '* process_dm | tweeting new tweet:\n\t' + output
+                self.outbox.enqueue('send_direct_message', output, tw.sender_id, tw.id)
+                print '* process_dm | queueing new tweet:\n\t' + output
                 return -1
-        
-        if conversation['num_messages'] < 4:
-            # for DMs we also have to let the analyze_image method know that it needs to upload a copy of the photo to microsoft
-            output = self.get_question(conversation, last_response=self.cleanup_tweet(tw, dm=True), dm=True)
             
             # tweet generated question
-            print '* process_dm | tweeting new tweet:\n\t' + output[0]
+            print '* process_dm | queueing new tweet:\n\t' + output[0]
             
-            response = self.twitter.send_direct_message(tw.sender_id, text=output[0])
             conversation = output[1]
-            conversation['involved_tweets'] += [tw.id, response.id]
-            conversation['last_tweet_id'] = response.id
-            
-            self.db.conversations.update_one({'image': conversation['image']}, {'$set': conversation})
-        elif conversation['num_messages'] < 5:
+            self.save_conversation(conversation, before)
+
+            # the message ids are recorded on the conversation once the reply has actually been sent
+            self.outbox.enqueue('send_direct_message', output[0], tw.sender_id, tw.id, conversation._id)
+        elif conversation.num_messages < 5:
             output = random.choice(self.conversation_excuses)
 
             # tweet generated question
-            print '* process_dm | tweeting new tweet:\n\t' + output
+            print '* process_dm | queueing new tweet:\n\t' + output
             
-            response = self.twitter.send_direct_message(tw.sender_id, text=output)
-            conversation['num_messages'] += 1
-            conversation['involved_tweets'] += [tw.id, response.id]
-            conversation['last_tweet_id'] = response.id
-            
-            self.db.conversations.update_one({'image': conversation['image']}, {'$set': conversation})
+            conversation.num_messages += 1
+            self.save_conversation(conversation, before)
+
+            self.outbox.enqueue('send_direct_message', output, tw.sender_id, tw.id, conversation._id)
         else:
             print '- process_dm | too many responses... waiting for new media message'
 
         return
 
     def confirmed(self, text):
-        sid = SentimentIntensityAnalyzer()
-        sent = sid.polarity_scores(text)
-        return sent['compound'] > 0
+        return self.confirmed_many([text])[0]
 
-    def process_new_tweets(self):
-        status = list(self.db.status.find({'type': 'current'}))[0]
-        last_tweet = int(status['last_tweet'])
-        
-        tweets = self.twitter.mentions_timeline(since_id=last_tweet, tweet_mode='extended', count=100)
-        if len(tweets) > 0:
-            if self.verbose:
-                print '- process_new_tweets | found ' + str(len(tweets)) + ' new tweets since ' + str(last_tweet)
-            
-        for tweet in tweets[::-1]:
-            if self.verbose:
-                print '- process_new_tweets | replying to tweet ' + str(tweet.id)
-            
-            self.process_tweet(tweet)
-        
-        if len(tweets) > 0:
-            if self.verbose:
-                print '- process_new_tweets | updating last_tweet status to ' + str(tweets[0].id)
+    def confirmed_many(self, texts):
+        with metrics.timer('sentiment'):
+            sid = sentiment_analyzer()
+            return [sid.polarity_scores(text)['compound'] > 0 for text in texts]
 
-            self.db.status.update_one({'type': 'current'}, {'$set': {'last_tweet': tweets[0].id}})
+    # score every reply in a batch in one pass. returns a score per tweet, None for new images.
+    def score_replies(self, tweets, dm=False):
+        replies = [t for t in tweets if 'media' not in t.entities]
+        scores = dict(zip([t.id for t in replies], self.confirmed_many([self.cleanup_tweet(t, dm=dm) for t in replies])))
+        return [scores.get(t.id) for t in tweets]
+
+    # new images start their own conversation, replies continue the one whose last tweet they answer
+    def tweet_key(self, tw):
+        if 'media' in tw.entities or not tw.in_reply_to_status_id:
+            return 'tweet:' + str(tw.id)
+        return 'tweet:' + str(tw.in_reply_to_status_id)
+
+    # DMs aren't threaded, so everything from one sender is a single conversation
+    def dm_key(self, tw):
+        return 'dm:' + str(tw.sender_id)
+
+    # messages are stored in jobs as twitter JSON, and turned back into tweepy models when a
+    # stage picks them up. tweepy doesn't keep the JSON for DMs, so those keep what we use.
+    def message_json(self, kind, message):
+        if kind == 'dm':
+            return {'id': message.id, 'text': message.text, 'sender_id': message.sender_id, 'entities': message.entities}
+        return message._json
+
+    def load_message(self, payload):
+        if payload['kind'] == 'dm':
+            return tweepy.DirectMessage.parse(self.twitter, payload['message'])
+        return tweepy.Status.parse(self.twitter, payload['message'])
+
+    # queue a page of messages. new images go to the analyze stage first and replies go
+    # straight to generate. replies are sentiment scored here, in one pass over the page.
+    def enqueue_messages(self, kind, items, key):
+        for message, confirmed in zip(items, self.score_replies(items, dm=kind == 'dm')):
+            payload = {'kind': kind, 'message': self.message_json(kind, message), 'confirmed': confirmed}
+            stage = 'analyze' if 'media' in message.entities else 'generate'
+            self.jobs.put(stage, kind + ':' + str(message.id), key(message), message.id, payload)
+
+    def analyze_job(self, job):
+        payload = job['payload']
+        message = self.load_message(payload)
+        try:
+            payload['image_details'] = self.analyze_image(message.entities['media'][0]['media_url'], dm=payload['kind'] == 'dm')
+        except VisionError as e:
+            # asking again won't help, so the generate stage goes straight to asking for another photo
+            print '! analyze_job | ERROR, could not analyze image: ' + str(e)
+            payload['vision_error'] = str(e)
+
+        self.jobs.put('generate', payload['kind'] + ':' + str(message.id), job['key'], job['seq'], payload)
+
+    def generate_job(self, job):
+        payload = job['payload']
+        message = self.load_message(payload)
+        if self.outbox.replied(message.id):
+            # answered before a crash or restart
+            return
+
+        if payload['kind'] == 'dm':
+            self.process_dm(message, image_details=payload.get('image_details'), confirmed=payload['confirmed'],
+                vision_error=payload.get('vision_error'))
+        else:
+            self.process_tweet(message, image_details=payload.get('image_details'), confirmed=payload['confirmed'],
+                vision_error=payload.get('vision_error'))
+
+    # lease and run jobs from one stage. run once, this returns when nothing is left that could
+    # start in the next couple of seconds; run forever, it keeps going until stop().
+    def work(self, stage, handler, forever=False):
+        while self.running or not forever:
+            job = self.jobs.lease(stage, shards=self.shards.owned if forever else None)
+            if job is None:
+                if not forever and self.jobs.depth(stage, within=2) == 0:
+                    return
+                time.sleep(1.0 if forever else 0.2)
+                continue
+
+            # questions have to be asked in order, so wait for earlier messages in the conversation
+            blocker = self.jobs.blocker(job) if stage == 'generate' else None
+            if blocker is not None:
+                wait = (blocker['available_at'] - datetime.datetime.utcnow()).total_seconds()
+                self.jobs.release(job, 0.5 if blocker['status'] == 'leased' or wait <= 0 else wait + 0.5)
+                continue
+
+            try:
+                with self.slots:
+                    handler(job)
+            except VisionUnavailable as e:
+                # the API is down, not this message. wait out the outage without using up attempts
+                if self.verbose: print '- work | vision unavailable (' + str(e) + '), deferring ' + job['_id']
+                metrics.count('job_deferred')
+                self.jobs.release(job, self.vision.cooldown)
+            except Exception as e:
+                self.jobs.retry(job, e)
+            else:
+                self.jobs.complete(job)
+
+    def stage_handlers(self):
+        return [('analyze', self.analyze_job), ('generate', self.generate_job)]
+
+    # work through everything queued, one stage after the other
+    def drain(self):
+        for stage, handler in self.stage_handlers():
+            workers = [threading.Thread(target=self.work, args=(stage, handler)) for _ in range(self.workers[stage])]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+
+    # background workers for every stage, for daemon mode. they only take jobs from the shards
+    # this process holds.
+    def start_workers(self):
+        self.shards = ShardLeases(self.db, socket.gethostname() + ':' + str(os.getpid()), on_change=self.shards_changed,
+            verbose=self.verbose)
+        self.shards.start()
+        self.start_question_pool()
+        sentiment_analyzer()
+
+        workers = []
+        for stage, handler in self.stage_handlers():
+            for _ in range(self.workers[stage]):
+                worker = threading.Thread(target=self.work, args=(stage, handler, True))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+        return workers
+
+    # cached conversations in shards another process now works on could go stale
+    def shards_changed(self, owned):
+        owned = set(owned)
+        self.conversations.retain(lambda key: shard_of(key) in owned)
+
+    def stop_workers(self, workers):
+        for worker in workers:
+            worker.join()
+        self.questions.stop()
+        self.shards.stop()
+
+    # run stage workers until stopped, without polling or sending. this is what each of the
+    # --workers processes does.
+    def run_workers(self, metrics_file=None, metrics_interval=15):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        self.running = True
+        workers = self.start_workers()
+        exported = time.time()
+        while self.running:
+            time.sleep(1.0)
+            if metrics_file is not None and time.time() - exported > metrics_interval:
+                self.export_metrics(metrics_file)
+                exported = time.time()
+        self.stop_workers(workers)
+        self.export_metrics(metrics_file)
+
+    # with drain=False the new messages are only queued, for the daemon's workers to pick up
+    def fetch_tweets(self, **kwargs):
+        return self.twitter.mentions_timeline(tweet_mode='extended', count=100, **kwargs)
+
+    def fetch_dms(self, **kwargs):
+        return self.twitter.direct_messages(count=100, **kwargs)
+
+    # a cheap look for anything to do, before any of the real work is set up: a backlog that was
+    # only partly read, queued jobs or replies, or a message newer than a watermark. the first
+    # page of new messages is kept for ingest, so twitter isn't asked for it twice.
+    def anything_new(self):
+        status = self.db.status.find_one({'type': 'current'})
+        if 'tweets_backlog' in status or 'dms_backlog' in status:
+            return True
+        if self.jobs.depth('analyze') + self.jobs.depth('generate') > 0:
+            return True
+        if self.db.outbox.find_one({'status': 'pending'}) is not None:
+            return True
+
+        new = False
+        for name, field, fetch in [('dms', 'last_dm', self.fetch_dms), ('tweets', 'last_tweet', self.fetch_tweets)]:
+            watermark = int(status[field])
+            items = fetch(since_id=watermark)
+            self.prefetched[name] = (watermark, items)
+            new = new or len(items) > 0
+        return new
+
+    def process_new_tweets(self, drain=True):
+        ingested = self.ingest('tweets', 'last_tweet', self.fetch_tweets, 'tweet', self.tweet_key)
+        if drain:
+            self.drain()
+        return ingested
+
+    def process_new_dms(self, drain=True):
+        ingested = self.ingest('dms', 'last_dm', self.fetch_dms, 'dm', self.dm_key)
+        if drain:
+            self.drain()
+        return ingested
+
+    # twitter only hands out 100 items per request, newest first, so a backlog is read by paging
+    # back from the newest item with max_id until we reach the watermark. only the page
+    # boundaries and sizes are kept, in <name>_backlog in the status document, and pages are
+    # queued oldest first. each queued page is popped from the list, so after a crash the next
+    # run picks up with the page it was on instead of skipping everything past the first 100.
+    def scan_backlog(self, name, fetch, watermark):
+        pages = []
+        fetched = {}
+        depth = 0
+        max_id = None
+        prefetched = self.prefetched.pop(name, None)
+        while True:
+            if max_id is None and prefetched is not None and prefetched[0] == watermark:
+                items = prefetched[1]
+            elif max_id is None:
+                items = fetch(since_id=watermark)
+            else:
+                items = fetch(since_id=watermark, max_id=max_id)
+            if len(items) == 0:
+                break
+
+            pages.append([items[0].id, len(items)])
+            fetched[items[0].id] = items[::-1]
+            depth += len(items)
+            max_id = items[-1].id - 1
+
+        backlog = {'pages': pages, 'depth': depth, 'processed': 0, 'started': time.time()}
+        return backlog, fetched
+
+    # queue everything newer than the watermark, one page at a time. once a page is safely in
+    # the job queue the watermark moves past it, by handing checkpoint the update for the status
+    # document (by default it is written straight away). returns how many messages were queued.
+    def ingest(self, name, field, fetch, kind, key, status=None, checkpoint=None):
+        if status is None:
+            status = self.db.status.find_one({'type': 'current'})
+        if checkpoint is None:
+            checkpoint = lambda update: self.db.status.update_one({'type': 'current'}, update)
+
+        watermark = int(status[field])
+        backlog = status.get(name + '_backlog')
+        fetched = {}
+        if backlog is None:
+            with self.slots:
+                backlog, fetched = self.scan_backlog(name, fetch, watermark)
+            if len(backlog['pages']) > 0:
+                checkpoint({'$set': {name + '_backlog': backlog}})
+        elif len(backlog['pages']) == 0:
+            checkpoint({'$unset': {name + '_backlog': ''}})
+
+        ingested = 0
+        while len(backlog['pages']) > 0:
+            page, size = backlog['pages'][-1]
+            if page in fetched:
+                items = fetched[page]
+            else:
+                with self.slots:
+                    items = fetch(since_id=watermark, max_id=page)[::-1]
 
-    def process_new_dms(self):
-        status = list(self.db.status.find({'type': 'current'}))[0]
-        last_dm = int(status['last_dm'])
-        
-        tweets = self.twitter.direct_messages(since_id=last_dm, count=100)
-        if len(tweets) > 0:
-            if self.verbose:
-                print '- process_new_dms | found ' + str(len(tweets)) + ' new DMs since ' + str(last_dm)
-            
-        for tweet in tweets[::-1]:
-            if self.verbose:
-                print '- process_new_dms | replying to DM ' + str(tweet.id)
-            
-            self.process_dm(tweet)
-        
-        if len(tweets) > 0:
             if self.verbose:
-                print '- process_new_dms | updating last_dm status to ' + str(tweets[0].id)
+                print '- ingest | queueing ' + str(len(items)) + ' ' + name + ' up to ' + str(page)
 
-            self.db.status.update_one({'type': 'current'}, {'$set': {'last_dm': tweets[0].id}})
+            self.enqueue_messages(kind, items, key)
+            ingested += len(items)
+
+            backlog['pages'].pop()
+            backlog['processed'] += size
+            watermark = page
+            if len(backlog['pages']) > 0:
+                checkpoint({'$set': {field: page, name + '_backlog': backlog}})
+            else:
+                checkpoint({'$set': {field: page}, '$unset': {name + '_backlog': ''}})
+
+        self.ingest_stats[name] = {
+            'backlog_depth': max(backlog['depth'] - backlog['processed'], 0),
+            'throughput': backlog['processed'] / max(time.time() - backlog['started'], 0.001)}
+        if backlog['depth'] > 0 and self.verbose:
+            print '- ingest | ' + name + ' backlog has ' + str(self.ingest_stats[name]['backlog_depth']) + \
+                ' left, catching up at ' + str(round(self.ingest_stats[name]['throughput'], 2)) + '/s'
+
+        return ingested
+
+    # ingest mentions and DMs at the same time. the status document is read once, and both
+    # sources' checkpoints are merged into a single update written when they have finished (or
+    # failed, in which case whatever was queued before the error is still committed). jobs are
+    # idempotent, so a crash before that write only means queueing the same pages again.
+    # returns how many messages were queued.
+    def poll(self):
+        status = self.db.status.find_one({'type': 'current'})
+        update = {'$set': {}, '$unset': {}}
+        lock = threading.Lock()
+        results = {}
+        errors = []
+
+        def checkpoint(change):
+            with lock:
+                for field, value in change.get('$set', {}).items():
+                    update['$unset'].pop(field, None)
+                    update['$set'][field] = value
+                for field in change.get('$unset', {}):
+                    update['$set'].pop(field, None)
+                    update['$unset'][field] = ''
+
+        def run(name, field, fetch, kind, key):
+            try:
+                results[name] = self.ingest(name, field, fetch, kind, key, status=status, checkpoint=checkpoint)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=run, args=('dms', 'last_dm', self.fetch_dms, 'dm', self.dm_key)),
+            threading.Thread(target=run, args=('tweets', 'last_tweet', self.fetch_tweets, 'tweet', self.tweet_key))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        update = dict((op, fields) for op, fields in update.items() if len(fields) > 0)
+        if len(update) > 0:
+            self.db.status.update_one({'type': 'current'}, update)
+        if len(errors) > 0:
+            raise errors[0]
+        return sum(results.values())
 
     def clear_new_tweets(self):
         tweets = self.twitter.mentions_timeline(tweet_mode='extended', count=1)
-        self.db.status.update_one({'type': 'current'}, {'$set': {'last_tweet': tweets[0].id}})
+        self.db.status.update_one({'type': 'current'}, {'$set': {'last_tweet': tweets[0].id}, '$unset': {'tweets_backlog': ''}})
+
+    # update the queue gauges and write the metrics out, if they are being collected
+    def export_metrics(self, path=None):
+        if not metrics.enabled:
+            return
+        metrics.gauge('jobs_analyze', self.jobs.depth('analyze'))
+        metrics.gauge('jobs_generate', self.jobs.depth('generate'))
+        metrics.gauge('outbox_pending', self.db.outbox.count({'status': 'pending'}))
+        metrics.gauge('conversation_cache_entries', self.conversations.stats()['entries'])
+        if path is not None:
+            metrics.write_json(path)
+
+    def stop(self, signum=None, frame=None):
+        print '- stop | stopping after the current poll'
+        self.running = False
+
+    # poll for new DMs and mentions until stopped by SIGINT/SIGTERM. the grammars, database
+    # connection and HTTP sessions stay warm between polls. the interval backs off while the
+    # bot is idle and snaps back to min_interval as soon as something arrives. with work=False
+    # the queued jobs are left to worker processes.
+    def run_forever(self, min_interval=15, max_interval=300, backoff=2.0, work=True, metrics_file=None,
+            compact_interval=60*60):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        self.running = True
+        self.outbox.start()
+        workers = self.start_workers() if work else []
+        interval = min_interval
+        next_compaction = time.time()
+
+        while self.running:
+            try:
+                processed = self.poll()
+            except Exception as e:
+                print '! run_forever | ERROR during poll: ' + str(e)
+                processed = 0
+
+            if time.time() >= next_compaction:
+                try:
+                    self.archive.compact()
+                except Exception as e:
+                    print '! run_forever | ERROR during compaction: ' + str(e)
+                next_compaction = time.time() + compact_interval
+
+            if processed >= 100:
+                # a full page came back, so there is probably more waiting
+                interval = 0
+            elif processed > 0:
+                interval = min_interval
+            else:
+                interval = min(max(interval, min_interval) * backoff, max_interval)
+
+            if self.verbose:
+                print '- run_forever | ingested ' + str(processed) + ', ' + str(self.jobs.depth('analyze')) + ' to analyze, ' + \
+                    str(self.jobs.depth('generate')) + ' to generate, sleeping ' + str(interval) + 's'
+            self.export_metrics(metrics_file)
+
+            # sleep in short steps so that a signal stops us promptly
+            deadline = time.time() + interval
+            while self.running and time.time() < deadline:
+                time.sleep(min(1.0, deadline - time.time()))
+
+        if work:
+            self.stop_workers(workers)
+        self.outbox.stop()
+
+# entry point for --workers processes. each builds its own generator, so that Mongo and HTTP
+# connections aren't shared across fork, and writes its own metrics file.
+def run_worker_process(api_keys, cookies, options, metrics_file=None):
+    metrics.enabled = metrics_file is not None
+    generator = QuestionGenerator(api_keys, cookies, **options)
+    generator.run_workers(metrics_file=metrics_file)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true', help='keep polling instead of exiting after one pass')
+    parser.add_argument('--min-interval', type=float, default=15, help='seconds between polls while busy')
+    parser.add_argument('--max-interval', type=float, default=300, help='seconds between polls while idle')
+    parser.add_argument('--threads', type=int, default=4, help='conversations to process concurrently')
+    parser.add_argument('--analyze-workers', type=int, help='threads running vision analysis (default: --threads)')
+    parser.add_argument('--generate-workers', type=int, help='threads generating questions (default: --threads)')
+    parser.add_argument('--concurrency', type=int, help='most twitter fetches and jobs to run at once (default: one per thread)')
+    parser.add_argument('--workers', type=int, default=0, help='with --daemon, run the stage workers in this many processes')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port')
+    parser.add_argument('--metrics-file', help='write metrics to this JSON file (--workers processes add .worker<N>)')
+    parser.add_argument('--compile-grammars', action='store_true', help='rebuild the compiled grammar files and exit')
+    parser.add_argument('--check-grammars', action='store_true', help='report problems in the grammars and exit')
+    parser.add_argument('--compact', action='store_true', help='archive finished conversations and exit (the daemon does this hourly)')
+    parser.add_argument('--archive-after', type=int, default=24*60*60, help='seconds before a finished conversation is archived')
+    parser.add_argument('--archive-idle-after', type=int, default=7*24*60*60, help='seconds without a message before an unfinished conversation is archived')
+    parser.add_argument('--archive-ttl', type=int, help='delete archived conversations after this many seconds (default: keep them)')
+    args = parser.parse_args()
+
+    if args.check_grammars:
+        failed = False
+        for name, entry_points in [('questions.json', EXPANSION_POINTS), ('prompts.json', ['#origin#'])]:
+            errors, warnings = check_grammar(load_grammar(os.path.join(GRAMMAR_DIR, name)), entry_points)
+            for error in errors:
+                print '! check_grammars | ERROR, ' + name + ': ' + error
+            for warning in warnings:
+                print '- check_grammars | warning, ' + name + ': ' + warning
+            failed = failed or len(errors) > 0
+        raise SystemExit(1 if failed else 0)
+
+    if args.compile_grammars:
+        for name in ['questions.json', 'prompts.json']:
+            path = os.path.join(GRAMMAR_DIR, name)
+            with open(path) as grammar_file:
+                source = grammar_file.read()
+            save_compiled_grammar(path, hashlib.sha1(source).hexdigest(), compile_grammar(json.loads(source)))
+            print '- compile_grammars | compiled ' + path
+        raise SystemExit
+
     with open('/home/loganw/tweetbot/api_keys.json') as key_file:
         api_keys = json.load(key_file)
 
     with open('/home/loganw/tweetbot/cookies.json') as cookie_file:    
         cookies = json.load(cookie_file)
 
-    generator = QuestionGenerator(api_keys, cookies)
+    options = {'threads': args.threads, 'analyze_workers': args.analyze_workers, 'generate_workers': args.generate_workers,
+        'concurrency': args.concurrency, 'archive_after': args.archive_after,
+        'archive_idle_after': args.archive_idle_after, 'archive_ttl': args.archive_ttl}
+    processes = []
+    if args.daemon and args.workers > 0:
+        processes = [multiprocessing.Process(target=run_worker_process, args=(api_keys, cookies, options,
+            args.metrics_file + '.worker' + str(i) if args.metrics_file else None)) for i in range(args.workers)]
+        for process in processes:
+            process.start()
+
+    metrics.enabled = args.metrics_port is not None or args.metrics_file is not None
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+
+    generator = QuestionGenerator(api_keys, cookies, **options)
 
-    generator.process_new_dms()
-    generator.process_new_tweets()
\ No newline at end of file
+    if args.compact:
+        print '- main | archived ' + str(generator.archive.compact()) + ' conversations'
+    elif args.daemon:
+        generator.run_forever(min_interval=args.min_interval, max_interval=args.max_interval, work=len(processes) == 0,
+            metrics_file=args.metrics_file)
+        for process in processes:
+            process.terminate()
+            process.join()
+    elif generator.anything_new():
+        generator.poll()
+        generator.drain()
+        generator.outbox.send_pending()
+        generator.export_metrics(args.metrics_file)
+    else:
+        print '- main | nothing new'
+        generator.export_metrics(args.metrics_file)